@@ -0,0 +1,3 @@
+'''
+Benchmark suite for Panuscript. See suite.py for the timed cases.
+'''
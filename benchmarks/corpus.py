@@ -0,0 +1,77 @@
+'''
+Synthetic corpora for the benchmark suite: a markdown manuscript with N citations,
+a BibTeX library with M entries and K PNG figures, also packed into a .docx.
+'''
+import os, random, struct, zipfile, zlib
+
+def png_bytes(width, height, seed=0):
+    '''
+    Returns the bytes of a valid RGB PNG image of the given size.
+    '''
+    rnd = random.Random(seed)
+    row = bytes(rnd.getrandbits(8) for _ in range(width * 3))
+    raw = b''.join(b'\x00' + row for _ in range(height))
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'pHYs', struct.pack('>IIB', 3780, 3780, 1)) +
+            chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+def bib_text(entries):
+    '''
+    Returns a BibTeX library with 'entries' articles keyed ref0..refM.
+    '''
+    out = []
+    for i in range(entries):
+        out.append('''@article{{ref{0},
+author = {{Author{0}, Given}},
+journal = {{Journal of Benchmarks}},
+keywords = {{bench,synthetic}},
+title = {{Synthetic entry {0}}},
+year = {{{1}}}
+}}'''.format(i, 1900 + i % 120))
+    return os.linesep.join(out) + os.linesep
+
+def md_text(citations, entries, images, seed=0):
+    '''
+    Returns a markdown manuscript with 'citations' @mentions drawn from 'entries' keys
+    (plus one unknown key, so xref has something to report) and 'images' figures.
+    '''
+    rnd = random.Random(seed)
+    out = ['---', 'title: Benchmark manuscript', '...', '']
+    for i in range(max(citations, 1)):
+        if i % 10 == 0: out.append('{}# Section {}{}'.format(os.linesep, i // 10, os.linesep))
+        if i < images: out.append('![Figure {0}](figure{0}.png)'.format(i))
+        key = 'ref{}'.format(rnd.randrange(entries)) if entries and i else 'missing0'
+        out.append('Lorem ipsum dolor sit amet, as noted by [@{}].'.format(key))
+    for i in range(citations, images):
+        out.append('![Figure {0}](figure{0}.png)'.format(i))
+    return os.linesep.join(out) + os.linesep
+
+def make_corpus(directory, citations=100, entries=50, images=5, image_size=64):
+    '''
+    Writes a synthetic corpus to 'directory' and returns a dictionary of its paths:
+    'md', 'bib', 'docx' and 'images' (a list).
+    '''
+    os.makedirs(directory, exist_ok=True)
+    ret = {'md': os.path.join(directory, 'bench.md'),
+            'bib': os.path.join(directory, 'bench.bib'),
+            'docx': os.path.join(directory, 'bench.docx'),
+            'images': []}
+    with open(ret['md'], 'w') as f:
+        f.write(md_text(citations, entries, images))
+    with open(ret['bib'], 'w') as f:
+        f.write(bib_text(entries))
+    with zipfile.ZipFile(ret['docx'], 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', '<?xml version="1.0"?><Types/>')
+        z.writestr('word/document.xml', '<?xml version="1.0"?><w:document/>')
+        for i in range(images):
+            data = png_bytes(image_size, image_size, seed=i)
+            path = os.path.join(directory, 'figure{}.png'.format(i))
+            with open(path, 'wb') as f:
+                f.write(data)
+            ret['images'].append(path)
+            z.writestr('word/media/image{}.png'.format(i + 1), data)
+    return ret
@@ -0,0 +1,123 @@
+'''
+Stand-in pandoc, pandoc-citeproc and magick executables for benchmarking.
+The stubs answer the capability probes Panuscript issues on startup and perform
+cheap but real file work (reading inputs, writing outputs, unzipping media) so the
+Python-side cost of every operation can be measured without the real programs.
+'''
+import os, stat, sys
+
+PANDOC_STUB = r'''
+import json, os, re, sys, zipfile
+
+INPUT_FORMATS = ['commonmark', 'docx', 'epub', 'html', 'json', 'latex', 'markdown',
+                'markdown_strict', 'odt', 'org', 'rst', 'textile']
+OUTPUT_FORMATS = ['asciidoc', 'commonmark', 'docx', 'epub', 'html', 'html5', 'json',
+                'latex', 'markdown', 'odt', 'org', 'plain', 'rst']
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('pandoc 2.7.3 (stub)')
+elif '--list-input-formats' in args:
+    print(os.linesep.join(INPUT_FORMATS))
+elif '--list-output-formats' in args:
+    print(os.linesep.join(OUTPUT_FORMATS))
+elif '--list-extensions' in args:
+    print(os.linesep.join(['+auto_identifiers', '+citations', '-east_asian_line_breaks', '+smart']))
+else:
+    media = [a.split('=', 1)[1] for a in args if a.startswith('--extract-media=')]
+    files = [a for a in args if not a.startswith('-') and os.path.isfile(a)]
+    out = args[args.index('-o') + 1] if '-o' in args else None
+    if media and files:
+        with zipfile.ZipFile(files[0]) as z:
+            for m in z.namelist():
+                if re.search(r'(^|/)(media|Pictures|images)/[^/]+$', m):
+                    dest = os.path.join(media[0], 'media', os.path.basename(m))
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    with open(dest, 'wb') as f:
+                        f.write(z.read(m))
+                    if '--verbose' in args: print('[INFO] Extracting {}...'.format(dest))
+    elif files and out and '--write=json' in args:
+        # a flat AST: a Header per '# ' line, a Para of one Str per other line
+        blocks = []
+        with open(files[0], 'r') as f:
+            for line in f:
+                if line.startswith('# '):
+                    ident = re.sub(r'[^a-z0-9]+', '-', line[2:].strip().lower()).strip('-')
+                    blocks.append({'t': 'Header', 'c': [1, [ident, [], []], [{'t': 'Str', 'c': line[2:].strip()}]]})
+                elif line.strip():
+                    blocks.append({'t': 'Para', 'c': [{'t': 'Str', 'c': line.strip()}]})
+        with open(out, 'w') as f:
+            json.dump({'pandoc-api-version': [1, 20], 'meta': {}, 'blocks': blocks}, f)
+    elif files and out and '--read=json' in args:
+        with open(files[0], 'r') as f:
+            doc = json.load(f)
+        with open(out, 'w') as f:
+            for b in doc['blocks']:
+                text = ' '.join(i['c'] for i in b['c'][-1] if i['t'] == 'Str') if b['t'] == 'Header' else b['c'][0]['c']
+                f.write('<{0} id="{1}">{2}</{0}>'.format('h1', b['c'][1][0], text) if b['t'] == 'Header' else '<p>{}</p>'.format(text))
+                f.write(chr(10))
+    elif files and out:
+        with open(files[0], 'rb') as f:
+            text = f.read()
+        with open(out, 'wb') as f:
+            f.write(text)
+'''
+
+CITEPROC_STUB = r'''
+import json, re, sys
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('pandoc-citeproc 0.16.2 (stub)')
+elif '--bib2json' in args or '--bib2yaml' in args:
+    with open(args[-1], 'r') as f:
+        text = f.read()
+    entries = []
+    for m in re.finditer(r'@(\w+)\{([^,]+),(.*?)\n\}', text, re.S):
+        e = {'id': m.group(2).strip(), 'type': m.group(1).lower()}
+        for k, v in re.findall(r'(\w+)\s*=\s*\{(.*?)\},?\n', m.group(3)):
+            if k == 'year': e['issued'] = {'date-parts': [[int(v)]]}
+            elif k == 'keywords': e['keyword'] = v
+            elif k == 'author':
+                fam, giv = (v.split(',', 1) + [''])[:2]
+                e['author'] = [{'family': fam.strip(), 'given': giv.strip()}]
+            else: e[k] = v
+        entries.append(e)
+    if '--bib2json' in args: print(json.dumps(entries, indent=2))
+    else: print('---' + chr(10) + json.dumps({'references': entries}) + chr(10) + '...')
+'''
+
+MAGICK_STUB = r'''
+import shutil, sys
+
+FORMATS = ['BMP', 'GIF', 'JPEG', 'JPG', 'PNG', 'TIFF', 'TIF', 'WEBP']
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('Version: ImageMagick 7.0.8 (stub)')
+elif '-list' in args:
+    for f in FORMATS:
+        print('{:>9}* rw+   {} stub format'.format(f, f))
+elif args and args[0] == 'convert':
+    paths = [a for a in args[1:] if not a.startswith('-') and '.' in a]
+    # '-write FILE' outputs, then the final output unless discarded with null:
+    outs = [args[i + 1] for i, a in enumerate(args[:-1]) if a == '-write']
+    if args[-1] != 'null:' and len(paths) >= 2: outs.append(paths[-1])
+    for out in outs:
+        shutil.copyfile(paths[0], out)
+'''
+
+STUBS = {'pandoc': PANDOC_STUB, 'pandoc-citeproc': CITEPROC_STUB, 'magick': MAGICK_STUB}
+
+def write_stubs(directory):
+    '''
+    Writes executable pandoc, pandoc-citeproc and magick stubs to the directory.
+    Returns the directory, suitable for prepending to PATH or for set_pandoc_dir().
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for name, body in STUBS.items():
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write('#!{}{}{}'.format(sys.executable, os.linesep, body.lstrip()))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
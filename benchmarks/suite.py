@@ -0,0 +1,185 @@
+'''
+Times the main Panuscript code paths over a synthetic corpus and reports
+latency percentiles and peak resident memory.
+By default the pandoc, pandoc-citeproc and magick executables are replaced by stubs
+(see stubs.py), so the suite measures Panuscript itself and runs on any Linux box.
+'''
+import os, sys, time, json, resource, shutil, subprocess, tempfile
+try:
+    from benchmarks.corpus import make_corpus
+    from benchmarks.stubs import write_stubs
+except ImportError:
+    from corpus import make_corpus
+    from stubs import write_stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = ['import', 'cli_help', 'startup', 'startup_cached', 'convert_doc', 'convert_doc_split', 'convert_image',
+        'convert_image_noop', 'image_info', 'image_derivatives', 'extract_media', 'library', 'xref_md']
+# p50 latency budgets in seconds, reported by report() and enforced by 'bench -check'
+BUDGETS = {'import': 0.05, 'cli_help': 0.25}
+# modules 'panuscript.py help' must not import, they are loaded on demand
+LAZY_MODULES = ['requests', 'src.ps_obj', 'src.library', 'concurrent.futures']
+
+def percentile(values, p):
+    '''
+    Returns the p-th percentile (0-100) of values, linearly interpolated between ranks.
+    '''
+    vals = sorted(values)
+    if not vals: return float('nan')
+    k = (len(vals) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(vals) - 1)
+    return vals[lo] + (vals[hi] - vals[lo]) * (k - lo)
+
+def peak_rss():
+    '''
+    Returns the peak resident set size in MiB of this process and of its largest child.
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0 # bytes on macOS, KiB elsewhere
+    return (own / scale, child / scale)
+
+def time_case(func, repeat):
+    '''
+    Calls func 'repeat' times and returns the wall time of each call in seconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def import_profile(args):
+    '''
+    Runs 'python -X importtime' with args from the repository root.
+    Returns a dictionary of each imported module's cumulative import time in seconds.
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=ROOT,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    ret = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, cumulative, module = line.split('|')
+        ret[module.strip()] = int(cumulative) / 1e6
+    return ret
+
+def import_times(repeat):
+    '''
+    Returns the import time of the CLI module (src.cli) in seconds for each of 'repeat' fresh interpreters.
+    '''
+    return [import_profile(['-c', 'import src.cli']).get('src.cli', float('nan')) for _ in range(repeat)]
+
+def lazy_violations():
+    '''
+    Returns the modules of LAZY_MODULES imported by 'panuscript.py help'.
+    '''
+    imported = import_profile([os.path.join(ROOT, 'panuscript.py'), 'help'])
+    return [m for m in LAZY_MODULES if m in imported]
+
+def cli_help():
+    subprocess.run([sys.executable, os.path.join(ROOT, 'panuscript.py'), 'help'],
+                    cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+
+def summarize(name, times):
+    return {'case': name, 'n': len(times), 'min': min(times),
+            'p50': percentile(times, 50), 'p90': percentile(times, 90),
+            'p99': percentile(times, 99), 'max': max(times),
+            'mean': sum(times) / len(times)}
+
+def run(citations=100, entries=50, images=5, repeat=10, cases=None, stubs=True, workdir=None):
+    '''
+    Generates a corpus in 'workdir' and times each case. Without a 'workdir' a temporary directory
+    is used and removed afterwards. PATH is restored when the run ends.
+    Returns a dictionary with the corpus parameters, per-case results and peak RSS.
+    If 'stubs' is False, the pandoc/magick executables found on PATH are used.
+    '''
+    temporary = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='panuscript-bench-')
+    path = os.environ.get('PATH')
+    try:
+        if stubs:
+            os.environ['PATH'] = write_stubs(os.path.join(workdir, 'bin')) + os.pathsep + (path or '')
+        return run_cases(workdir, citations, entries, images, repeat, cases, stubs)
+    finally:
+        if path is None: os.environ.pop('PATH', None)
+        else: os.environ['PATH'] = path
+        if temporary: shutil.rmtree(workdir, ignore_errors=True)
+
+def run_cases(workdir, citations, entries, images, repeat, cases, stubs):
+    '''
+    Generates the corpus in workdir and times each case. See run().
+    '''
+    corpus = make_corpus(os.path.join(workdir, 'corpus'), citations, entries, images)
+    from src.ps_obj import Panuscript, CAPABILITIES
+    from src.library import Library
+
+    ps = Panuscript()
+    ps.configure(verbose=False)
+    img = corpus['images'][0] if corpus['images'] else None
+    funcs = {'cli_help': cli_help,
+            # a new process probes every executable, later objects reuse the probed capabilities
+            'startup': lambda: (CAPABILITIES.clear(), Panuscript()),
+            'startup_cached': Panuscript,
+            'convert_doc': lambda: ps.convert_doc(corpus['md'], 'markdown', 'html5'),
+            'convert_doc_split': lambda: ps.convert_doc_split(corpus['md'], 'markdown', 'html5'),
+            'convert_image': lambda: ps.convert_image(img, os.path.splitext(img)[0] + '.tiff'),
+            # the corpus images are 96 ppi PNGs, so a PNG output at the default settings is a copy
+            'convert_image_noop': lambda: ps.convert_image(img, os.path.splitext(img)[0] + '-copy.png'),
+            'image_info': lambda: ps.image_info(img),
+            'image_derivatives': lambda: ps.image_derivatives(img),
+            'extract_media': lambda: ps.extract_media(corpus['docx']),
+            'library': lambda: Library(corpus['bib'], ps=ps),
+            'xref_md': lambda: ps.xref_md(corpus['md'], corpus['bib'])}
+    results = []
+    for name in cases or CASES:
+        if name == 'import': times = import_times(repeat)
+        elif name not in funcs: raise ValueError('Unknown benchmark case: {}'.format(name))
+        elif name in ['convert_image', 'convert_image_noop', 'image_info', 'image_derivatives'] and img is None: continue
+        else: times = time_case(funcs[name], repeat)
+        r = summarize(name, times)
+        if name in BUDGETS: r.update(budget=BUDGETS[name], ok=r['p50'] <= BUDGETS[name])
+        results.append(r)
+    own, child = peak_rss()
+    return {'workdir': workdir, 'stubs': stubs, 'citations': citations, 'entries': entries,
+            'images': images, 'repeat': repeat, 'results': results,
+            'lazy_violations': lazy_violations(), 'peak_rss_mib': own, 'peak_child_rss_mib': child}
+
+def passed(bench):
+    '''
+    Returns True if every budgeted case is within its p50 budget and no lazy module is imported eagerly.
+    '''
+    return all(r.get('ok', True) for r in bench['results']) and not bench['lazy_violations']
+
+def report(bench):
+    '''
+    Formats the dictionary returned by run() as a plain text table (times in ms).
+    '''
+    cols = ['n', 'min', 'p50', 'p90', 'p99', 'max', 'mean']
+    out = 'Panuscript benchmarks ({} executables){}'.format(
+            'stub' if bench['stubs'] else 'real', os.linesep)
+    out += 'Corpus: {} citations, {} bibliography entries, {} images, {} repeats{}'.format(
+            bench['citations'], bench['entries'], bench['images'], bench['repeat'], os.linesep*2)
+    out += '{:<20}'.format('case') + ''.join('{:>10}'.format(c) for c in cols) + '    budget' + os.linesep
+    for r in bench['results']:
+        out += '{:<20}{:>10}'.format(r['case'], r['n'])
+        out += ''.join('{:>10.2f}'.format(r[c] * 1000) for c in cols[1:])
+        if 'budget' in r:
+            out += '{:>10.0f} {}'.format(r['budget'] * 1000, 'ok' if r['ok'] else 'OVER')
+        out += os.linesep
+    if bench['lazy_violations']:
+        out += '{}Imported by \'panuscript.py help\' but should be lazy: {}{}'.format(
+                os.linesep, ', '.join(bench['lazy_violations']), os.linesep)
+    out += '{}Peak RSS: {:.1f} MiB (largest child process: {:.1f} MiB){}'.format(
+            os.linesep, bench['peak_rss_mib'], bench['peak_child_rss_mib'], os.linesep)
+    return out
+
+def write_json(bench, path):
+    with open(path, 'w') as f:
+        json.dump(bench, f, indent=2)
+    return path
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    print(report(run(repeat=5)))
@@ -1,5 +1,5 @@
 import sys
-from src.cli import *
+from src.cli import run
 
 def main():
     print('add gui stuff as main function')
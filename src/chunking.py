@@ -0,0 +1,173 @@
+'''
+Splitting of large markdown documents at top-level headings, and stitching of the
+Pandoc JSON ASTs of the parts back into one document. Used by Panuscript.convert_doc_split().
+'''
+import os, re
+
+MARKDOWN_READERS = ['markdown', 'markdown_strict', 'markdown_phpextra', 'markdown_mmd',
+                    'markdown_github', 'commonmark', 'commonmark_x', 'gfm']
+
+FENCE = re.compile(r'^\s{0,3}(`{3,}|~{3,})')
+ATX_H1 = re.compile(r'^#(\s|$)')
+SETEXT_H1 = re.compile(r'^=+\s*$')
+ATX = re.compile(r'^#{1,6}\s+(.*?)(\s+#+)?\s*$')
+SETEXT = re.compile(r'^(=+|-+)\s*$')
+HEADER_ATTR = re.compile(r'\s*\{([^}]*)\}\s*$')
+# reference link ([id]: url) and footnote ([^id]: text) definitions
+DEFINITION = re.compile(r'^\s{0,3}\[[^\]]+\]:')
+LINK_DEFINITION = re.compile(r'^\s{0,3}\[([^\]^][^\]]*)\]:')
+# example list items and references, (@) or (@label), which Pandoc numbers across the whole document
+EXAMPLE = re.compile(r'\(@[\w-]*\)')
+
+def front_matter(lines):
+    '''
+    Returns the number of lines of the YAML metadata block opening the document (0 if none).
+    '''
+    if not lines or lines[0].rstrip() != '---': return 0
+    for i in range(1, len(lines)):
+        if lines[i].rstrip() in ['---', '...']: return i + 1
+    return 0
+
+def header_id(text):
+    '''
+    Returns the identifier Pandoc's auto_identifiers extension gives a heading, approximated
+    from its markdown source: formatting, footnotes and link targets are removed, characters
+    other than letters, digits, '_', '-' and '.' dropped, spaces become hyphens, the text is
+    lowercased and everything before the first letter removed.
+    '''
+    text = re.sub(r'\[\^[^\]]*\]', '', text)
+    text = re.sub(r'!?\[([^\]]*)\](\([^)]*\)|\[[^\]]*\])?', r'\1', text)
+    text = re.sub(r'<[^>]+>', '', text)
+    text = re.sub(r'[^\w\s.-]|_(?=[\s_]|$)|(?<=[\s_])_', '', text) # '_' emphasis, not snake_case
+    text = re.sub(r'\s+', '-', text.strip()).lower()
+    for i, c in enumerate(text):
+        if c.isalpha(): return text[i:]
+    return 'section'
+
+def header_references(headers, defined):
+    '''
+    Returns explicit reference definitions ('[Heading text]: #identifier') for (text, identifier)
+    headers, so implicit header references resolve in every chunk as in a single parse. As in
+    Pandoc, the first of several headings with the same text wins, identifiers are made unique in
+    document order and labels defined by the document ('defined') take precedence.
+    '''
+    out, seen, labels = [], set(), set(defined)
+    for text, ident in headers:
+        if ident is None:
+            base = header_id(text)
+            ident, k = base, 0
+            while ident in seen:
+                k += 1
+                ident = '{}-{}'.format(base, k)
+        seen.add(ident)
+        label = ' '.join(text.lower().split())
+        if label and label not in labels and not re.search(r'[\[\]]', text):
+            labels.add(label)
+            out.append('[{}]: #{}\n'.format(text, ident))
+    return ''.join(out)
+
+def split_markdown(text, parts, header_refs=False):
+    '''
+    Splits markdown text at level one headings (outside code blocks) into at most 'parts'
+    chunks of similar size. Returns (metadata, definitions, chunks): the leading YAML block and
+    the reference link/footnote definitions, which every chunk needs, and the chunk texts.
+    With 'header_refs', definitions also include a reference for every heading (see
+    header_references()), for readers with the implicit_header_references extension.
+    '''
+    lines = text.splitlines(True)
+    n = front_matter(lines)
+    meta, body = ''.join(lines[:n]), lines[n:]
+
+    sections, current, definitions, headers = [], [], [], []
+    fence, in_note = None, False
+    for i, line in enumerate(body):
+        m = FENCE.match(line)
+        if fence:
+            if m and m.group(1)[0] == fence[0] and len(m.group(1)) >= len(fence): fence = None
+            current.append(line)
+            continue
+        if m:
+            fence = m.group(1)
+            in_note = False
+            current.append(line)
+            continue
+        # definitions, and the indented continuation lines of footnotes, go to every chunk
+        if DEFINITION.match(line):
+            in_note = line.lstrip().startswith('[^')
+            definitions.append(line)
+            continue
+        if in_note and not line.strip():
+            definitions.append(line)
+            current.append(line)
+            continue
+        if in_note and line.startswith((' ', '\t')):
+            definitions.append(line)
+            continue
+        in_note = False
+        blank_before = not current or not current[-1].strip()
+        setext = i + 1 < len(body) and SETEXT_H1.match(body[i + 1]) and line.strip() and blank_before
+        h = ATX.match(line)
+        if h or (i + 1 < len(body) and SETEXT.match(body[i + 1]) and line.strip() and blank_before):
+            title = h.group(1) if h else line.strip()
+            attr = HEADER_ATTR.search(title)
+            ident = None
+            if attr:
+                title = title[:attr.start()]
+                ident = ([a[1:] for a in attr.group(1).split() if a.startswith('#')] or [None])[0]
+            headers.append((title.strip(), ident))
+        if (ATX_H1.match(line) or setext) and any(l.strip() for l in current):
+            sections.append(''.join(current))
+            current = []
+        current.append(line)
+    if current: sections.append(''.join(current))
+
+    # merge consecutive sections into chunks of roughly equal size
+    target = sum(len(s) for s in sections) / max(int(parts), 1)
+    chunks, size = [], 0
+    for s in sections:
+        if chunks and size + len(s) / 2 <= target:
+            chunks[-1] += s
+            size += len(s)
+        else:
+            chunks.append(s)
+            size = len(s)
+    definitions = ''.join(definitions)
+    if header_refs:
+        defined = [' '.join(m.group(1).lower().split()) for m in map(LINK_DEFINITION.match,
+                    definitions.splitlines()) if m]
+        definitions += header_references(headers, defined)
+    return meta, definitions, chunks
+
+def unique_ids(blocks, seen):
+    '''
+    Renames repeated Header identifiers the way Pandoc does for a single document
+    ('intro', 'intro-1', ...). 'seen' carries the identifiers of earlier chunks.
+    '''
+    for b in blocks:
+        if b.get('t') == 'Header':
+            attr = b['c'][1]
+            ident = attr[0]
+            if ident:
+                new, k = ident, 0
+                while new in seen:
+                    k += 1
+                    new = '{}-{}'.format(ident, k)
+                attr[0] = new
+                seen.add(new)
+        elif b.get('t') == 'Div':
+            unique_ids(b['c'][1], seen)
+    return blocks
+
+def stitch_ast(docs):
+    '''
+    Concatenates the blocks of several Pandoc JSON ASTs (as dictionaries) into one document,
+    keeping the first document's metadata and API version. Metadata keys only set in later
+    chunks are added.
+    '''
+    out = {'pandoc-api-version': docs[0].get('pandoc-api-version'), 'meta': dict(docs[0].get('meta', {})),
+            'blocks': []}
+    seen = set()
+    for d in docs:
+        for k, v in d.get('meta', {}).items(): out['meta'].setdefault(k, v)
+        out['blocks'] += unique_ids(d.get('blocks', []), seen)
+    return out
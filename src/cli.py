@@ -1,49 +1,83 @@
-import os
+import os, sys
 
 def run(args):
-    from src.ps_obj import Panuscript
-    ps = Panuscript()
-    ps.configure(link_citations=False, verbose=False,
-                                atx_header=False, preserve_tabs=False,
-                                grayscale=False)
-
     func = args[1].strip().lower().strip('-')
     if len(args) > 2: cargs = args[2:]
     else: cargs = []
+    if func == 'bench':
+        # benchmarks construct their own Panuscript objects against stub or real executables
+        return print(Function(None, func, [a.strip('-') for a in cargs]).result)
+
+    flags = [a.replace('--', '-').strip() for a in cargs]
+    profile = [a for a in flags if a.startswith('-profile')]
+    trace = [a.split('=',1)[1] for a in flags if a.startswith('-trace=')]
+    if not profile and not trace: return execute(func, cargs)
+
+    from src.tracing import tracer, StageSummary
+    summary = tracer.add_hook(StageSummary())
+    if trace: tracer.open_trace(os.path.abspath(trace[0]))
+    try:
+        if profile and '=' in profile[0]:
+            import cProfile, pstats
+            stats_file = os.path.abspath(profile[0].split('=',1)[1])
+            prof = cProfile.Profile()
+            try: prof.runcall(execute, func, cargs)
+            finally:
+                prof.dump_stats(stats_file)
+                pstats.Stats(prof).sort_stats('cumulative').print_stats(15)
+        else: execute(func, cargs)
+    finally:
+        tracer.remove_hook(summary)
+        tracer.close_trace()
+    if profile: print(summary.report())
+
+def execute(func, cargs):
     fargs = []
-    cite_info = (False, None, None, False)
+    settings = [] # setter calls, applied once a Panuscript object is needed
+    cite_info = {'val':False, 'biblio':None, 'csl':None, 'link_citations':False}
     # configure panuscript
     for a in cargs:
         a = a.replace('--', '-').strip()
         if a.startswith('-p-exe='):
-            ps.set_pandoc_dir(a.split('=',1)[1])
+            settings.append(('set_pandoc_dir', a.split('=',1)[1]))
         elif a.startswith('-pc-exe='):
-            ps.set_citeproc_dir(a.split('=',1)[1])
+            settings.append(('set_citeproc_dir', a.split('=',1)[1]))
         elif a.startswith('-m-exe='):
-            ps.set_magick_dir(a.split('=',1)[1])
+            settings.append(('set_magick_dir', a.split('=',1)[1]))
         elif a.startswith('-wd='):
-            key, val = a.split('=',1)
-            ps.set_working_directory(a.split('=',1)[1])
-        elif a.startswith('-v'): ps.set_verbose(True)
+            settings.append(('set_working_directory', a.split('=',1)[1]))
+        elif a.startswith('-v'): settings.append(('set_verbose', True))
         elif a.startswith('-ppi='):
-            ps.set_ppi(a.split('=',1)[1])
+            settings.append(('set_ppi', int(a.split('=',1)[1])))
         elif a.startswith('-pdf-engine='):
-            ps.set_pdf_engine(a.split('=',1)[1])
-        elif a.startswith('-citations'): cite_info[0] = True
+            settings.append(('set_pdf_engine', a.split('=',1)[1]))
+        elif a.startswith('-citations'): cite_info['val'] = True
         elif a.startswith('-bib='):
-            cite_info[1] = a.split('=',1)[1]
+            cite_info['biblio'] = a.split('=',1)[1]
         elif a.startswith('-csl='):
-            cite_info[2] = a.split('=',1)[1]
-        elif a.startswith('-link-citations'): cite_info[3] = True
+            cite_info['csl'] = a.split('=',1)[1]
+        elif a.startswith('-link-citations'): cite_info['link_citations'] = True
         elif a.startswith('-toc-depth='):
-            ps.set_toc_depth(a.split('=',1)[1])
-        elif a.startswith('-atx'): ps.set_atx_header(True)
-        elif a.startswith('-preserve-tabs'): ps.set_tab_preservation(True)
+            settings.append(('set_toc_depth', int(a.split('=',1)[1])))
+        elif a.startswith('-atx'): settings.append(('set_atx_header', True))
+        elif a.startswith('-preserve-tabs'): settings.append(('set_tab_preservation', True))
         elif a.startswith('-resize='):
-            ps.set_resizing_factor(a.split('=',1)[1])
-        elif a.startswith('-grayscale'): ps.set_grayscale(True)
+            settings.append(('set_resizing_factor', float(a.split('=',1)[1])))
+        elif a.startswith('-grayscale'): settings.append(('set_grayscale', True))
+        elif a.startswith('-profile') or a.startswith('-trace='): pass
         else: fargs.append(a.strip('-'))
-    ps.set_citations(cite_info[0], cite_info[1], cite_info[2], cite_info[3])
+
+    # help text needs no executables, so Panuscript (and its probing) is only loaded to run a
+    # function. info has no help text and always reports the executables.
+    if func in ['h','help'] or (('h' in fargs or 'help' in fargs) and func not in ['i','info']): ps = None
+    else:
+        from src.ps_obj import Panuscript
+        ps = Panuscript()
+        ps.configure(link_citations=False, verbose=False,
+                                    atx_header=False, preserve_tabs=False,
+                                    grayscale=False)
+        for setter, val in settings: getattr(ps, setter)(val)
+        ps.set_citations(**cite_info)
 
     # run function
     f = Function(ps, func, fargs)
@@ -54,9 +88,16 @@ class Function:
     def __init__(self, ps, function, arglist):
         if function == 'fetch-csl': self.result = FETCHCSL(ps, arglist).result
         elif function =='extract-media': self.result = EXTRACTMEDIA(ps, arglist).result
+        elif function =='extract-media-many': self.result = EXTRACTMEDIAMANY(ps, arglist).result
         elif function == 'convert-document': self.result = CONVERTDOCUMENT(ps, arglist).result
         elif function == 'convert-image': self.result = CONVERTIMAGE(ps, arglist).result
+        elif function == 'image-info': self.result = IMAGEINFO(ps, arglist).result
+        elif function == 'image-derivatives': self.result = IMAGEDERIVATIVES(ps, arglist).result
+        elif function == 'srcset-html': self.result = SRCSETHTML(ps, arglist).result
         elif function == 'xref': self.result = XREF(ps, arglist).result
+        elif function == 'run-manifest': self.result = RUNMANIFEST(ps, arglist).result
+        elif function == 'jobs': self.result = JOBS(ps, arglist).result
+        elif function == 'bench': self.result = BENCH(ps, arglist).result
         elif function in ['i','info']: self.result = INFO(ps, arglist).result
         elif function in ['h','help']: self.result = HELP(ps, arglist).result
         else: self.result = None
@@ -99,6 +140,35 @@ Example usage: ... extract-media --input='/path/to/file'
                     self.args[key] = val
             self.result = ps.extract_media(self.args['input'])
 
+class EXTRACTMEDIAMANY(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Extracts media content from several files in parallel, each to its own directory.
+Required arguments:
+    --inputs= >> a STRING of the paths to the input files, delimited by ';'
+Optional arguments:
+    --workers= >> an INT of the number of files extracted at once. Defaults to the CPU count.
+    --manifest= >> a STRING of the path of a JSON file mapping each input file to its extracted files
+    --store= >> a STRING of the path of a job store (JSON lines) recording each extraction. See the jobs command.
+    -resume >> with --store, skip files whose recorded extraction completed and is unchanged
+Example usage: ... extract-media-many --inputs='a.docx;b.odt' --workers=4 --manifest=media.json --store=jobs.jsonl -resume
+'''
+        self.args = {'inputs':None, 'workers':None, 'manifest':None, 'store':None, 'resume':False}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            for a in args:
+                if a == 'resume': self.args['resume'] = True
+                else:
+                    key, val = a.split('=')
+                    if key == 'inputs': self.args[key] = val.split(';')
+                    else: self.args[key] = val
+            store = None
+            if self.args['store']:
+                from src.jobstore import JobStore
+                store = JobStore(ps.normalize_path(self.args['store']))
+            self.result = ps.extract_media_many(self.args['inputs'], self.args['workers'],
+                                                self.args['manifest'], store, self.args['resume'])
+
 class CONVERTDOCUMENT(Function):
     def __init__(self, ps, args):
         self.help = '''
@@ -106,25 +176,36 @@ Converts between document formats. See [info] for a supported formats.
 Required Arguments:
     --input= >> a STRING of the path to the input file
 Optional Arguments:
-    --read= >> a STRING specifying the inputfile format. Panuscript will attempt to infer the format if unspecified. Default is raw text.
-    --write= >>  a STRING specifying the inputfile format. Panuscript will attempt to infer the format if unspecified. Default is raw text.
+    --output= >> a STRING of the path to the output file. Defaults to the input path with the extension of the output format.
+    --read= >> a STRING specifying the inputfile format. Inferred from the input file extension if unspecified.
+    --write= >>  a STRING specifying the outputfile format. Inferred from the output file extension if unspecified.
     --args= >> a STRING containing custom formated arguments for Pandoc, delimited by ';'. Must be properly formatted for Pandoc.
+    -split >> for large markdown files: split the input at level one headings and parse the parts in parallel before writing the whole document. Writing (citeproc, writer, PDF engine) still runs once over the whole document, so this does not reduce memory and is slower unless parsing dominates.
+    --workers= >> an INT of the number of parts parsed at once with -split. Defaults to the CPU count.
 Example usage: ... convert-document --input='/path/to/file' --output='/path/to/file' --read=markdown --write=docx --args=--dpi=96;--pdf-engine;pdflatex
 '''
-        self.args = {'input':None,'read':None,'write':None,'args':None}
+        self.args = {'input':None,'output':None,'read':None,'write':None,'args':None,'split':False,'workers':None}
         if 'h' in args or 'help' in args: self.result = self.help
         else:
             for a in args:
-                key, val = a.split('=')
-                if key == 'args': self.args[key] = val.split(";")
-                else: self.args[key] = val
-            self.result = ps.convert_doc(self.args['input'], self.args['read'],
-                                    self.args['write'], self.args['args'])
+                if a == 'split': self.args['split'] = True
+                else:
+                    key, val = a.split('=')
+                    if key == 'args': self.args[key] = val.split(";")
+                    else: self.args[key] = val
+            if self.args['split']:
+                self.result = ps.convert_doc_split(self.args['input'], self.args['read'],
+                                    self.args['write'], self.args['args'], workers=self.args['workers'],
+                                    output=self.args['output'])
+            else:
+                self.result = ps.convert_doc(self.args['input'], self.args['read'],
+                                    self.args['write'], self.args['args'], output=self.args['output'])
 
 class CONVERTIMAGE(Function):
     def __init__(self, ps, args):
         self.help = '''
 Converts between image formats. See [info] for a list of supported formats.
+If the input already is in the output format with the requested density and size (and no args are given), it is copied without running ImageMagick.
 Required Arguments:
     --input= >> a STRING of the path to the input file
     --output= >> a STRING of the path to the output file
@@ -141,6 +222,77 @@ Example usage: ... convert-image --input='/path/to/file' --output='/path/to/file
                 else: self.args[key] = val
             self.result = ps.convert_image(self.args['input'], self.args['output'], self.args['args'])
 
+class IMAGEINFO(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Prints the format, dimensions, bit depth, channels, colorspace, density (pixels per inch) and decoded
+size of PNG, JPEG, TIFF and GIF images, read from their headers without running ImageMagick.
+Required arguments:
+    --input= >> a STRING of the path to the image, or several paths delimited by ';'
+Example usage: ... image-info --input='fig1.png;fig2.jpg'
+'''
+        self.args = {'input':None}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            for a in args:
+                key, val = a.split('=')
+                self.args[key] = val
+            out = os.linesep
+            for f in self.args['input'].split(';'):
+                info = ps.image_info(f)
+                if info is None:
+                    out += '{}  unrecognized image{}'.format(f, os.linesep)
+                    continue
+                density = '{:.0f}x{:.0f} ppi'.format(*info['density']) if info['density'] else 'no density'
+                out += '{}  {} {}x{} {}-bit {} ({} channels), {}, {:.1f} MiB decoded{}'.format(f,
+                        info['format'], info['width'], info['height'], info['depth'], info['colorspace'],
+                        info['channels'], density, info['bytes'] / 1048576.0, os.linesep)
+            self.result = out
+
+class IMAGEDERIVATIVES(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Writes several sizes and formats of images (e.g. for responsive HTML/EPUB), decoding each image only once.
+Files are named '<image name>-<label>.<format>'. Images are never upscaled.
+Required arguments:
+    --input= >> a STRING of the path to the input image, or several paths delimited by ';'
+Optional arguments:
+    --sizes= >> a STRING of derivatives as label:width:format[+format], delimited by ','. Default is thumb:160:webp+png,1x:800:webp+png,2x:1600:webp+png
+    --out-dir= >> a STRING of the directory to write to. Defaults to each image's directory.
+    --html= >> a STRING of the path to an HTML file whose <img> references are rewritten to use the derivatives (see srcset-html)
+    --args= >> a STRING containing custom formated arguments for ImageMagick, delimited by ';'.
+Example usage: ... image-derivatives --input='fig1.png;fig2.png' --sizes=thumb:160:png,1x:800:webp+png --html=paper.html
+'''
+        self.args = {'input':None, 'sizes':None, 'out-dir':None, 'html':None, 'args':None}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            for a in args:
+                key, val = a.split('=')
+                if key == 'args': self.args[key] = val.split(";")
+                else: self.args[key] = val
+            self.result = [f for i in self.args['input'].split(';') for f in ps.image_derivatives(
+                        i, self.args['sizes'], self.args['out-dir'], self.args['args']) or []]
+            if self.args['html']: ps.srcset_html(self.args['html'], self.args['sizes'], self.args['out-dir'])
+
+class SRCSETHTML(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Rewrites the <img> references of an HTML file to responsive srcset/<picture> markup using derivatives written by image-derivatives.
+Required arguments:
+    --html= >> a STRING of the path to the HTML file
+Optional arguments:
+    --sizes= >> a STRING of the derivatives, as given to image-derivatives
+    --out-dir= >> a STRING of the directory the derivatives were written to, as given to image-derivatives. Defaults to each image's directory.
+Example usage: ... srcset-html --html=paper.html --sizes=thumb:160:png,1x:800:webp+png --out-dir=img
+'''
+        self.args = {'html':None, 'sizes':None, 'out-dir':None}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            for a in args:
+                key, val = a.split('=')
+                self.args[key] = val
+            self.result = ps.srcset_html(self.args['html'], self.args['sizes'], self.args['out-dir'])
+
 class XREF(Function):
     def __init__(self, ps, args):
         self.help = '''
@@ -158,6 +310,104 @@ Example usage: ... extract-media --input='/path/to/file'
                 self.args[key] = val
             self.result = ps.xref_md(self.args['md'], self.args['bib'])
 
+class RUNMANIFEST(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Runs the jobs listed in a YAML or JSON manifest in one process. Jobs name a function (fetch-csl, extract-media,
+convert-document, convert-image, xref) with the same arguments as on the command line, and may depend on
+other jobs through 'after' or 'from'. Independent jobs run in parallel. See src/pipeline.py for the format.
+Required arguments:
+    --manifest= >> a STRING of the path to the manifest file
+Optional arguments:
+    --workers= >> an INT of the number of jobs run at once. Defaults to the manifest value, else the CPU count.
+    -keep-going >> keep running jobs that do not depend on a failed job. By default no new jobs start after a failure.
+    --store= >> a STRING of the path of a job store (JSON lines) recording every job. Defaults to the manifest's 'store' value, if any.
+    -resume >> with a store, skip jobs whose recorded run completed with the same inputs and settings
+    -retry-failed >> with a store, only run jobs whose last recorded run failed
+Example usage: ... run-manifest --manifest=build.yaml --workers=4 -keep-going --store=jobs.jsonl -resume
+'''
+        self.args = {'manifest':None, 'workers':None, 'keep-going':None, 'store':None,
+                    'resume':False, 'retry-failed':False}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            from src.pipeline import Pipeline, load_manifest
+            for a in args:
+                if a in ['keep-going', 'resume', 'retry-failed']: self.args[a] = True
+                else:
+                    key, val = a.split('=')
+                    self.args[key] = val
+            manifest = ps.normalize_path(self.args['manifest'])
+            base_dir = os.path.dirname(os.path.abspath(manifest))
+            spec = load_manifest(manifest)
+            store = None
+            if self.args['store'] or spec.get('store'):
+                from src.jobstore import JobStore
+                if self.args['store']: store = JobStore(ps.normalize_path(self.args['store']))
+                else: store = JobStore(os.path.join(base_dir, spec['store']))
+            pipe = Pipeline(spec, ps, self.args['workers'], self.args['keep-going'], base_dir,
+                            store, self.args['resume'], self.args['retry-failed'])
+            pipe.run()
+            self.result = os.linesep + pipe.report()
+
+class JOBS(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Lists jobs recorded in a job store by run-manifest or extract-media-many.
+Required arguments:
+    --store= >> a STRING of the path to the job store
+Optional arguments:
+    --slowest= >> an INT of the number of slowest jobs to list. Default is 10.
+    -failing >> list the jobs whose last run failed instead
+Example usage: ... jobs --store=jobs.jsonl --slowest=20
+'''
+        self.args = {'store':None, 'slowest':10, 'failing':False}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            from src.jobstore import JobStore
+            for a in args:
+                if a == 'failing': self.args['failing'] = True
+                else:
+                    key, val = a.split('=')
+                    self.args[key] = val
+            store = JobStore(ps.normalize_path(self.args['store']))
+            if self.args['failing']: records = store.failing()
+            else: records = store.slowest(int(self.args['slowest']))
+            self.result = os.linesep + store.summary(records)
+
+class BENCH(Function):
+    def __init__(self, ps, args):
+        self.help = '''
+Times Panuscript startup, document and image conversion, media extraction, bibliography loading and xref over a synthetic corpus.
+Reports latency percentiles (ms) and peak memory. Stub pandoc/magick executables are used unless -real is given.
+Optional arguments:
+    --citations= >> an INT of the number of citations in the generated markdown file. Default is 100.
+    --entries= >> an INT of the number of entries in the generated bibliography. Default is 50.
+    --images= >> an INT of the number of generated images. Default is 5.
+    --repeat= >> an INT of the number of timed runs per case. Default is 10.
+    --cases= >> a STRING of cases to run, delimited by ';'. Default is all of: import;cli_help;startup;convert_doc;convert_image;extract_media;library;xref_md
+    --json= >> a STRING of the path to write the full results to as JSON.
+    -real >> use the pandoc/magick executables on PATH instead of stubs.
+    -check >> exit with an error if a startup budget is exceeded or 'help' imports a module that should be lazy.
+Example usage: ... bench --citations=1000 --entries=500 --images=20 --repeat=5 --json=bench.json
+'''
+        self.args = {'citations':100, 'entries':50, 'images':5, 'repeat':10,
+                    'cases':None, 'json':None, 'real':False, 'check':False}
+        if 'h' in args or 'help' in args: self.result = self.help
+        else:
+            from benchmarks.suite import run, report, write_json, passed
+            for a in args:
+                if a in ['real', 'check']: self.args[a] = True
+                else:
+                    key, val = a.split('=')
+                    if key == 'cases': self.args[key] = val.split(';')
+                    elif key == 'json': self.args[key] = val
+                    else: self.args[key] = int(val)
+            bench = run(self.args['citations'], self.args['entries'], self.args['images'],
+                        self.args['repeat'], self.args['cases'], stubs=not self.args['real'])
+            if self.args['json']: write_json(bench, self.args['json'])
+            self.result = report(bench)
+            if self.args['check'] and not passed(bench): sys.exit(self.result)
+
 class INFO(Function):
     def __init__(self, ps, args):
         out = 'Panuscript v.{}{}'.format(ps.VERSION, os.linesep*2)
@@ -188,9 +438,16 @@ Panuscript Help.
 The first command must be the fuction command. The following function commands are recognized:
 fetch-csl           Downloads a citation style language.
 extract-media       Extracts media files from an input file.
+extract-media-many  Extracts media files from several input files in parallel.
 convert-document    Converts document file formats. Must be configured to render citations.
 convert-image       Converts image formats.
+image-info          Prints the dimensions, density and colorspace of images without decoding them.
+image-derivatives   Writes several sizes and formats of images from one decode.
+srcset-html         Rewrites HTML image references to responsive srcset markup.
 xref                Cross references citations from a markdown file with entries from bibliography file.
+run-manifest        Runs the jobs of a YAML or JSON manifest, in parallel where independent.
+jobs                Lists the slowest or failing jobs recorded in a job store.
+bench               Times Panuscript operations over a synthetic corpus.
 -h, --help          Prints additional information.
 
 The -h or --help flag can also be used after a function command for function specific information.
@@ -216,6 +473,8 @@ The following univeral arguments are be used to configure Panuscript behaviour:
 -preserve-tabs      Preserves tabs while rendering code blocks
 --resize=           Sets the percent by which images are resized during conversion
 -grayscale          Conversion outputs are in grayscale
+--profile           Prints a per-stage timing summary after the run. --profile=FILE also runs under cProfile and saves the stats to FILE
+--trace=            Appends a JSON line per timed stage (every executable call and Python phase) to the given file
 
 
 Example Usage:
@@ -0,0 +1,115 @@
+'''
+Reads the dimensions, density, colorspace and bit depth of PNG, JPEG, TIFF and GIF images
+from their headers, without decoding them or starting ImageMagick. Files are memory-mapped so
+only the pages holding the header structures are read from disk. Used by
+Panuscript.convert_image() to skip conversions that would not change the image.
+'''
+import os, mmap, struct
+
+# file extension: format name, as used by image_info()
+IMAGE_FORMATS = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.jpe': 'jpeg',
+                '.tif': 'tiff', '.tiff': 'tiff', '.gif': 'gif'}
+PNG_COLOR = {0: ('Gray', 1), 2: ('sRGB', 3), 3: ('sRGB', 3), 4: ('Gray', 2), 6: ('sRGB', 4)}
+JPEG_COLOR = {1: 'Gray', 3: 'sRGB', 4: 'CMYK'}
+# start of frame markers, i.e. every SOFn except DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF = [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+TIFF_COLOR = {0: 'Gray', 1: 'Gray', 2: 'sRGB', 3: 'sRGB', 5: 'CMYK', 6: 'YCbCr'}
+TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8)}
+
+def png_info(m):
+    width, height, depth, color = struct.unpack_from('>IIBB', m, 16)
+    colorspace, channels = PNG_COLOR.get(color, (None, 1))
+    info = {'format': 'png', 'width': width, 'height': height, 'depth': depth,
+            'channels': channels, 'colorspace': colorspace, 'density': None}
+    # walk the chunks up to the image data; pHYs must precede IDAT
+    pos = 8
+    while pos + 8 <= len(m):
+        length, kind = struct.unpack_from('>I4s', m, pos)
+        if kind in [b'IDAT', b'IEND']: break
+        if kind == b'pHYs':
+            x, y, unit = struct.unpack_from('>IIB', m, pos + 8)
+            if unit == 1: info['density'] = (x * 0.0254, y * 0.0254) # pixels per metre
+        pos += length + 12
+    return info
+
+def tiff_info(m, start=0, fmt='tiff'):
+    '''
+    Reads the first image directory of a TIFF structure beginning at 'start'. Also used for the
+    Exif block of JPEG files.
+    '''
+    order = '<' if m[start:start + 2] == b'II' else '>'
+    if struct.unpack_from(order + 'H', m, start + 2)[0] != 42: return None # e.g. BigTIFF
+    ifd = start + struct.unpack_from(order + 'I', m, start + 4)[0]
+    tags = {}
+    for i in range(struct.unpack_from(order + 'H', m, ifd)[0]):
+        tag, kind, count = struct.unpack_from(order + 'HHI', m, ifd + 2 + i * 12)
+        if kind not in TIFF_TYPES: continue
+        code, size = TIFF_TYPES[kind]
+        pos = ifd + 10 + i * 12
+        if size * count > 4: pos = start + struct.unpack_from(order + 'I', m, pos)[0]
+        val = struct.unpack_from(order + code, m, pos)
+        if kind == 5: val = (val[0] / float(val[1] or 1),) # RATIONAL
+        tags[tag] = val
+    scale = {2: 1.0, 3: 2.54}.get(tags.get(296, (2,))[0])
+    density = None
+    if scale and 282 in tags: density = (tags[282][0] * scale, tags.get(283, tags[282])[0] * scale)
+    return {'format': fmt, 'width': tags.get(256, (None,))[0], 'height': tags.get(257, (None,))[0],
+            'depth': tags.get(258, (1,))[0], 'channels': tags.get(277, (1,))[0],
+            'colorspace': TIFF_COLOR.get(tags.get(262, (None,))[0]), 'density': density}
+
+def jpeg_info(m):
+    info = {'format': 'jpeg', 'density': None}
+    pos = 2
+    while pos + 4 <= len(m):
+        if m[pos] != 0xFF:
+            pos += 1
+            continue
+        marker = m[pos + 1]
+        if marker == 0xFF or 0xD0 <= marker <= 0xD8 or marker == 0x01: # fill byte or markers without a length
+            pos += 1 if marker == 0xFF else 2
+            continue
+        if marker == 0xDA: break # start of scan, the compressed data follows
+        length = struct.unpack_from('>H', m, pos + 2)[0]
+        body = pos + 4
+        if marker == 0xE0 and m[body:body + 5] == b'JFIF\x00':
+            unit, x, y = struct.unpack_from('>BHH', m, body + 7)
+            scale = {1: 1.0, 2: 2.54}.get(unit)
+            if scale and info['density'] is None: info['density'] = (x * scale, y * scale)
+        elif marker == 0xE1 and m[body:body + 6] == b'Exif\x00\x00':
+            exif = tiff_info(m, body + 6)
+            # Exif resolution takes precedence over JFIF, as in ImageMagick
+            if exif and exif['density']: info['density'] = exif['density']
+        elif marker in JPEG_SOF:
+            depth, height, width, channels = struct.unpack_from('>BHHB', m, body)
+            info.update(width=width, height=height, depth=depth, channels=channels,
+                        colorspace=JPEG_COLOR.get(channels))
+        pos = body + length - 2
+    return info if 'width' in info else None
+
+def gif_info(m):
+    width, height, packed = struct.unpack_from('<HHB', m, 6)
+    return {'format': 'gif', 'width': width, 'height': height, 'depth': (packed & 7) + 1,
+            'channels': 3, 'colorspace': 'sRGB', 'density': None}
+
+def image_info(path):
+    '''
+    Returns a dictionary of an image's format, width, height, bit depth (per channel), channels,
+    colorspace (ImageMagick names: Gray, sRGB, CMYK, YCbCr), density as (x, y) pixels per inch
+    (None if not recorded) and the approximate size in bytes of the decoded pixels.
+    Returns None for other formats or unreadable headers.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < 16: return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                head = m[:8]
+                if head == b'\x89PNG\r\n\x1a\n': info = png_info(m)
+                elif head[:3] == b'\xff\xd8\xff': info = jpeg_info(m)
+                elif head[:4] in [b'II*\x00', b'MM\x00*']: info = tiff_info(m)
+                elif head[:6] in [b'GIF87a', b'GIF89a']: info = gif_info(m)
+                else: info = None
+    except (OSError, ValueError, struct.error, IndexError):
+        return None
+    if info is None or not info['width'] or not info['height']: return None
+    info['bytes'] = info['width'] * info['height'] * info['channels'] * max(info['depth'] // 8, 1)
+    return info
@@ -0,0 +1,115 @@
+'''
+An append-only JSON-lines record of Panuscript jobs, used to resume batch runs.
+Each line records one run of a job: its key (a hash of the function, arguments, settings
+and the contents of the job's input files), the input hashes, settings, output, status, error
+and duration. The latest record of a key is its current state.
+'''
+import os, json, time, hashlib, threading
+
+# settings naming files a job reads
+SETTING_INPUTS = ['Bibliography file', 'CSL file']
+
+class JobStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.hashes = {}
+        self.load()
+
+    def load(self):
+        '''
+        Reads the store file, keeping the latest record per key. A partially written last line
+        (e.g. after a crash) is ignored.
+        '''
+        self.latest = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try: rec = json.loads(line)
+                    except ValueError: continue
+                    self.latest[rec['key']] = rec
+        return self
+
+    def file_hash(self, path):
+        '''
+        Returns the sha256 of a file's contents, cached by path, size and modification time.
+        '''
+        st = os.stat(path)
+        cache_key = (path, st.st_size, st.st_mtime_ns)
+        if cache_key not in self.hashes:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''): h.update(block)
+            self.hashes[cache_key] = h.hexdigest()
+        return self.hashes[cache_key]
+
+    def inputs(self, paths, settings):
+        '''
+        Returns {path: sha256} for the input paths (and the bibliography and CSL files of the
+        settings) that exist. Outputs must not be passed: they only exist after the first run,
+        which would change the key.
+        '''
+        vals = list(paths) + [settings.get(k) for k in SETTING_INPUTS]
+        paths = [p for v in vals for p in (v if isinstance(v, list) else [v])
+                    if isinstance(p, str) and os.path.isfile(p)]
+        return dict((p, self.file_hash(p)) for p in paths)
+
+    def key(self, function, args, settings, paths=()):
+        '''
+        Returns (key, input hashes) identifying a job: the same function, arguments and settings
+        over unchanged input files ('paths') give the same key. Other arguments, such as output
+        paths, are part of the key as plain strings.
+        '''
+        inputs = self.inputs(paths, settings)
+        blob = json.dumps([function, args, settings, inputs], sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest(), inputs
+
+    def record(self, key, function, args, inputs, settings, output, status, duration, error=None):
+        rec = {'key': key, 'function': function, 'args': args, 'inputs': inputs,
+                'settings': settings, 'output': output, 'status': status,
+                'error': None if error is None else str(error), 'duration': duration, 'time': time.time()}
+        line = json.dumps(rec, default=str)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + os.linesep)
+            self.latest[key] = rec
+        return rec
+
+    def last(self, key):
+        return self.latest.get(key)
+
+    def completed(self, key):
+        '''
+        Returns True if the job's latest run succeeded and its outputs still exist.
+        '''
+        rec = self.latest.get(key)
+        if rec is None or rec['status'] != 'done': return False
+        out = rec['output']
+        if isinstance(out, dict): out = [f for v in out.values() for f in v or []]
+        paths = [p for p in (out if isinstance(out, list) else [out]) if isinstance(p, str)]
+        return all(os.path.exists(p) for p in paths if os.path.isabs(p))
+
+    def slowest(self, n=10):
+        '''
+        Returns the latest records of the n slowest jobs.
+        '''
+        return sorted(self.latest.values(), key=lambda r: -(r['duration'] or 0))[:n]
+
+    def failing(self):
+        '''
+        Returns the latest records of jobs whose last run failed.
+        '''
+        return [r for r in self.latest.values() if r['status'] == 'failed']
+
+    def summary(self, records):
+        '''
+        Formats records as a plain text table.
+        '''
+        out = ''
+        for r in records:
+            args = ' '.join(str(a) for a in r['args'] if a is not None)
+            out += '{:<18}{:<8}{:>9.2f}s  {}{}'.format(r['function'], r['status'],
+                    r['duration'] or 0, args, os.linesep)
+            if r['error']: out += '{:<18}{}{}'.format('', r['error'], os.linesep)
+        return out
@@ -1,4 +1,6 @@
 import os, re, json
+try: from src.tracing import span, traced
+except: from tracing import span, traced
 
 class Entry:
     def __init__(self, d):
@@ -14,11 +16,14 @@ class Library:
         self.entries = []
         self.read(file)
 
+    @traced('library.read')
     def read(self, path):
         if os.path.isfile(path):
             if os.path.splitext(path)[1] in self.ps.bib_formats:
                 with open(path, 'r') as text:
-                    lib = [Entry(e) for e in json.loads(self.ps.json_bib(path))]
+                    bib_json = self.ps.json_bib(path)
+                    with span('library.parse', path=path):
+                        lib = [Entry(e) for e in json.loads(bib_json)]
                     # clean entries
                     for e in lib:
                         if hasattr(e, 'keyword'): e.keyword = e.keyword.split(',')
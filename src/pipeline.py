@@ -0,0 +1,249 @@
+'''
+Runs a manifest of Panuscript jobs in one process.
+A manifest is a YAML (.yml/.yaml) or JSON file:
+
+    settings:               # keyword arguments for Panuscript.configure()
+        ppi: 300
+        citations: true
+        biblio: refs.bib
+    workers: 4              # optional, threads running independent jobs
+    keep_going: false       # optional, see Pipeline
+    store: jobs.jsonl       # optional job store, see jobstore.py
+    jobs:
+      - id: media
+        function: extract-media
+        input: paper.docx
+      - id: figures
+        function: convert-image
+        from: media         # run once per file returned by the 'media' job
+        output: '{stem}.tiff'
+      - id: docx
+        function: convert-document
+        input: paper.md
+        read: markdown
+        write: docx
+        after: [figures]
+
+Jobs name a CLI function and take the same arguments as the CLI. Dependencies ('after'
+and 'from') form a DAG; independent jobs run in parallel and share one Panuscript object,
+so executables are probed once. Relative paths resolve against the manifest's directory.
+'''
+import os, json, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# CLI function name: (Panuscript method, ordered arguments)
+FUNCTIONS = {'fetch-csl': ('fetch_csl', ['style', 'update']),
+            'extract-media': ('extract_media', ['input']),
+            'extract-media-many': ('extract_media_many', ['inputs', 'workers', 'manifest']),
+            'convert-document': ('convert_doc', ['input', 'read', 'write', 'args']),
+            'convert-image': ('convert_image', ['input', 'output', 'args']),
+            'image-info': ('image_info', ['input']),
+            'image-derivatives': ('image_derivatives', ['input', 'sizes', 'out-dir', 'args']),
+            'srcset-html': ('srcset_html', ['html', 'sizes', 'out-dir']),
+            'xref': ('xref_md', ['md', 'bib'])}
+PATH_ARGS = ['input', 'inputs', 'output', 'out-dir', 'md', 'bib', 'html', 'manifest']
+# arguments naming files a job reads, hashed into its job store key
+INPUT_ARGS = ['input', 'inputs', 'md', 'bib']
+
+def load_manifest(path):
+    '''
+    Returns the manifest at path as a dictionary. YAML manifests require PyYAML.
+    '''
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1].lower() in ['.yml', '.yaml']:
+            try: import yaml
+            except ImportError:
+                raise ImportError('Reading the YAML manifest {} requires PyYAML. Install it '
+                                '(pip install pyyaml) or use a JSON manifest.'.format(path)) from None
+            return yaml.safe_load(f)
+        return json.load(f)
+
+class Job:
+    def __init__(self, spec, index):
+        spec = dict(spec)
+        self.id = str(spec.pop('id', 'job{}'.format(index)))
+        self.function = spec.pop('function', None)
+        if self.function not in FUNCTIONS:
+            raise ValueError('Job \'{}\' has an unsupported function: {}'.format(self.id, self.function))
+        self.source = spec.pop('from', None)
+        after = spec.pop('after', [])
+        self.after = [after] if isinstance(after, str) else list(after)
+        if self.source and self.source not in self.after: self.after.append(self.source)
+        self.params = spec
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.duration = None
+
+def failed(result):
+    '''
+    Panuscript methods signal failure by returning None, an error string or exception object.
+    '''
+    if isinstance(result, list): return any(failed(r) for r in result)
+    if isinstance(result, dict): return any(failed(r) for r in result.values())
+    return result is None or result == 'Unknown error' or isinstance(result, Exception)
+
+class JobSkipped(Exception):
+    '''
+    Raised for jobs left out of a retry-failed run.
+    '''
+
+class Pipeline:
+    '''
+    Builds a DAG from a manifest's jobs and runs it.
+    In fail-fast mode (default) no new jobs start after a failure, in keep-going mode
+    only the jobs depending on a failed job are skipped.
+    If 'store' (a JobStore) is given every call is recorded. With 'resume' calls whose recorded run
+    completed with the same inputs and settings are not run again; 'retry_failed' additionally
+    skips calls without a failed record, so only failures are retried.
+    '''
+    def __init__(self, manifest, ps, workers=None, keep_going=None, base_dir='',
+                    store=None, resume=False, retry_failed=False):
+        self.ps = ps
+        self.store = store
+        self.resume = resume
+        self.retry_failed = retry_failed
+        self.base_dir = os.path.abspath(base_dir)
+        self.workers = int(workers or manifest.get('workers') or os.cpu_count() or 1)
+        if keep_going is None: keep_going = manifest.get('keep_going', False)
+        self.keep_going = keep_going
+        self.settings = manifest.get('settings') or {}
+        self.jobs = {}
+        for i, spec in enumerate(manifest.get('jobs') or []):
+            job = Job(spec, i)
+            if job.id in self.jobs: raise ValueError('Duplicate job id: {}'.format(job.id))
+            self.jobs[job.id] = job
+        self.order = self.topological_order()
+
+    def topological_order(self):
+        '''
+        Returns the job ids ordered so every job follows its dependencies.
+        Raises ValueError for unknown dependencies or cycles.
+        '''
+        order, state = [], {}
+        def visit(jid, chain):
+            if state.get(jid) == 'done': return
+            if state.get(jid) == 'visiting':
+                raise ValueError('Dependency cycle: {}'.format(' -> '.join(chain + [jid])))
+            state[jid] = 'visiting'
+            for dep in self.jobs[jid].after:
+                if dep not in self.jobs:
+                    raise ValueError('Job \'{}\' depends on unknown job \'{}\''.format(jid, dep))
+                visit(dep, chain + [jid])
+            state[jid] = 'done'
+            order.append(jid)
+        for jid in self.jobs: visit(jid, [])
+        return order
+
+    def resolve(self, key, val):
+        if key == 'inputs' and isinstance(val, str): val = val.split(';')
+        if key in PATH_ARGS and isinstance(val, list):
+            return [self.resolve(key, v) for v in val]
+        if key in PATH_ARGS and isinstance(val, str) and not os.path.isabs(val):
+            return os.path.join(self.base_dir, val)
+        return val
+
+    def call(self, job, params):
+        method, names = FUNCTIONS[job.function]
+        if job.function == 'convert-document' and params.get('split'): method = 'convert_doc_split'
+        args = [self.resolve(n, params.get(n)) for n in names]
+        if job.function == 'fetch-csl': args[1] = bool(args[1])
+        if names[-1] == 'args':
+            if isinstance(args[-1], str): args[-1] = args[-1].split(';')
+            if args[-1] is None: args = args[:-1]
+        kwargs = {}
+        if job.function == 'convert-document' and params.get('output'):
+            kwargs['output'] = self.resolve('output', params['output'])
+        if method == 'convert_doc_split' and params.get('workers'):
+            kwargs['workers'] = int(params['workers'])
+        if self.store is None: return getattr(self.ps, method)(*args, **kwargs)
+
+        settings = self.ps.settings()
+        paths = [a for n, a in zip(names, args) if n in INPUT_ARGS]
+        key, inputs = self.store.key(job.function, args + [kwargs.get('output')], settings, paths)
+        if (self.resume or self.retry_failed) and self.store.completed(key):
+            return self.store.last(key)['output']
+        rec = self.store.last(key)
+        if self.retry_failed and (rec is None or rec['status'] != 'failed'): raise JobSkipped(key)
+        start = time.perf_counter()
+        ret, error = None, None
+        try:
+            ret = getattr(self.ps, method)(*args, **kwargs)
+            return ret
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            self.store.record(key, job.function, args, inputs, settings, ret,
+                    'failed' if error is not None or failed(ret) else 'done',
+                    time.perf_counter() - start, error)
+
+    def execute(self, job):
+        '''
+        Runs a single job, expanding it over its source job's results if it has one.
+        '''
+        start = time.perf_counter()
+        try:
+            if job.source:
+                src = self.jobs[job.source].result
+                if isinstance(src, dict): src = [f for v in src.values() for f in v] # extract-media-many
+                results = []
+                for path in ([src] if isinstance(src, str) else src or []):
+                    d, name = os.path.split(path)
+                    fmt = {'path': path, 'dir': d, 'name': name, 'stem': os.path.splitext(name)[0]}
+                    params = dict(job.params, input=path)
+                    if isinstance(params.get('output'), str):
+                        params['output'] = os.path.join(d, params['output'].format(**fmt))
+                    try: results.append(self.call(job, params))
+                    except JobSkipped: pass
+                job.result = results
+            else: job.result = self.call(job, job.params)
+            job.status = 'failed' if failed(job.result) else 'done'
+        except JobSkipped:
+            job.status = 'skipped'
+        except Exception as err:
+            job.error = err
+            job.status = 'failed'
+        job.duration = time.perf_counter() - start
+        return job
+
+    def run(self):
+        '''
+        Configures the Panuscript object from the manifest settings and runs all jobs.
+        Returns True if every job completed.
+        '''
+        if 'workdir' not in self.settings: self.ps.set_working_directory(self.base_dir)
+        if self.settings: self.ps.configure(**self.settings)
+        pending = list(self.order)
+        running = {}
+        stop = False
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for jid in list(pending):
+                    job = self.jobs[jid]
+                    deps = [self.jobs[d].status for d in job.after]
+                    if stop or any(s in ['failed', 'skipped'] for s in deps):
+                        job.status = 'skipped'
+                        pending.remove(jid)
+                    elif all(s == 'done' for s in deps) and len(running) < self.workers:
+                        job.status = 'running'
+                        running[pool.submit(self.execute, job)] = jid
+                        pending.remove(jid)
+                if not running: continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    job = self.jobs[running.pop(fut)]
+                    if job.status == 'failed' and not self.keep_going: stop = True
+        return all(j.status == 'done' for j in self.jobs.values())
+
+    def report(self):
+        '''
+        Returns the status, duration and result of every job as a plain text table.
+        '''
+        out = ''
+        for jid in self.order:
+            job = self.jobs[jid]
+            dur = '{:.2f}s'.format(job.duration) if job.duration is not None else '-'
+            res = job.error if job.error is not None else job.result
+            out += '{:<20}{:<18}{:<9}{:>9}  {}{}'.format(jid, job.function, job.status, dur, res, os.linesep)
+        return out
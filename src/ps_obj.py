@@ -1,7 +1,13 @@
-import os, platform, shutil, sys, math, re, requests
+import os, platform, shutil, sys, math, re, json, functools, tempfile, time, struct, zipfile
 from subprocess import CalledProcessError, Popen, PIPE, STDOUT
 try: from src.library import Library
 except: from library import Library
+try: from src.tracing import span, traced
+except: from tracing import span, traced
+try: from src.chunking import EXAMPLE, MARKDOWN_READERS, split_markdown, stitch_ast
+except: from chunking import EXAMPLE, MARKDOWN_READERS, split_markdown, stitch_ast
+try: from src.imageinfo import IMAGE_FORMATS, image_info
+except: from imageinfo import IMAGE_FORMATS, image_info
 
 class Panuscript(object):
     '''
@@ -16,13 +22,13 @@ class Panuscript(object):
             self.ext = ''
         self.p_exe_name = "pandoc{}".format(self.ext)
         self.p_exe_path = os.path.dirname(shutil.which(
-            self.p_exe_name) or path.dirname(path.abspath(__file__)))
+            self.p_exe_name) or os.path.abspath(__file__))
         self.pc_exe_name = "pandoc-citeproc{}".format(self.ext)
         self.pc_exe_path = os.path.dirname(shutil.which(
-            self.pc_exe_name) or path.dirname(path.abspath(__file__)))
+            self.pc_exe_name) or os.path.abspath(__file__))
         self.m_exe_name = "magick{}".format(self.ext)
         self.m_exe_path = os.path.dirname(shutil.which(
-            self.m_exe_name) or path.dirname(path.abspath(__file__)))
+            self.m_exe_name) or os.path.abspath(__file__))
         self.work_dir = ""
         self.verbose = True
         self.ppi = 96
@@ -51,13 +57,25 @@ class Panuscript(object):
                         args=['convert', '--version']) + os.linesep
         return ret
 
-    def update_exe_info(self):
+    @traced('probe')
+    def update_exe_info(self, refresh=False):
         '''
         Updates exe information with current exe paths.
+        Results are cached per set of executables (and their modification times) for the
+        life of the process, so further Panuscript objects do not probe again unless 'refresh'.
         '''
-        self.info = self.get_exe_info()
-        self.pandoc_extensions = self.installed_pandoc_extensions()
-        self.pandoc_formats, self.bib_formats, self.magick_formats = self.supported_formats()
+        exes = [os.path.join(self.p_exe_path, self.p_exe_name),
+                os.path.join(self.pc_exe_path, self.pc_exe_name),
+                os.path.join(self.m_exe_path, self.m_exe_name)]
+        key = tuple((e, os.path.getmtime(e) if os.path.isfile(e) else None) for e in exes)
+        if refresh or key not in CAPABILITIES:
+            info = self.get_exe_info()
+            extensions = self.installed_pandoc_extensions()
+            CAPABILITIES[key] = (info, extensions) + self.supported_formats()
+        (self.info, self.pandoc_extensions, self.pandoc_formats,
+            self.bib_formats, self.magick_formats) = CAPABILITIES[key]
+        self.pandoc_readers = format_registry(tuple(self.pandoc_formats['input']))[1]
+        self.pandoc_writers = format_registry(tuple(self.pandoc_formats['output']))[1]
         return self
 
     def set_pandoc_dir(self, path_str):
@@ -149,7 +167,7 @@ class Panuscript(object):
             if depth >= 1 and depth <= 6:
                 self.toc_depth = depth
             elif depth > 6:
-                if self.ps.verbose: print("TOC depth was lowered to the maximum value of 6.")
+                if self.verbose: print("TOC depth was lowered to the maximum value of 6.")
                 self.toc_depth = 6
             else:
                 self.toc_depth = 0
@@ -161,8 +179,8 @@ class Panuscript(object):
         If true, ATX headers are used in markdown, and if false, Setext headers are used.
         '''
         if type(val) is bool:
-            self.atx_head = val
-        return self.atx_head
+            self.atx_header = val
+        return self.atx_header
 
     def set_tab_preservation(self, val):
         '''
@@ -170,8 +188,8 @@ class Panuscript(object):
         True preserves tabs in literal code blocks, false converts tabs to spaces.
         '''
         if type(val) is bool:
-            self.preserve_tab = val
-        return self.preserve_tab
+            self.tab_preservation = val
+        return self.tab_preservation
 
     def set_resizing_factor(self, val):
         '''
@@ -180,8 +198,8 @@ class Panuscript(object):
         '''
         val = math.floor(val)
         if type(val) is int:
-            self.re_size = val
-        return self.re_size
+            self.sizing_factor = val
+        return self.sizing_factor
 
     def set_grayscale(self, val):
         '''
@@ -189,8 +207,8 @@ class Panuscript(object):
         If grayscale is enabled, images will be converted to grayscale.
         '''
         if type(val) is bool:
-            self.gray_scale = val
-        return self.gray_scale
+            self.grayscale = val
+        return self.grayscale
 
     def configure(self, verbose=None, workdir=None, ppi=None, pdf_engine=None,
                     citations=None, biblio=None, csl='apa', link_citations=False,
@@ -202,18 +220,24 @@ class Panuscript(object):
         if pdf_engine != None: self.set_pdf_engine(pdf_engine)
         if citations != None and biblio != None:
             self.set_citations(citations, biblio, csl, link_citations)
-        if toc != None: cfg.set_toc_depth(toc)
+        if toc != None: self.set_toc_depth(toc)
         if atx_header != None: self.set_atx_header(atx_header)
         if preserve_tabs != None: self.set_tab_preservation(preserve_tabs)
         if resize_percent != None: self.set_resizing_factor(resize_percent)
         if grayscale != None: self.set_grayscale(grayscale)
-        ret = {'Working Directory':self.work_dir, 'Verbose':self.verbose,
-                'PPI':self.ppi, 'PDF engine':self.pdf_engine, 'Citations':self.citations,
+        ret = {'Working Directory':self.work_dir, 'Verbose':self.verbose}
+        ret.update(self.settings())
+        return '~Configuration~{}{}'.format(os.linesep, dict_to_table(ret))
+
+    def settings(self):
+        '''
+        Returns the settings that affect conversion outputs.
+        '''
+        return {'PPI':self.ppi, 'PDF engine':self.pdf_engine, 'Citations':self.citations,
                 'Bibliography file':self.bibliography, 'CSL file':self.csl,
                 'Linked citations': self.link_citations, 'Table of Contents':self.toc_depth,
                 'ATX headers':self.atx_header, 'Preserve tabs':self.tab_preservation,
                 'Resizing factor (%)':self.sizing_factor, 'Grayscale':self.grayscale}
-        return '~Configuration~{}{}'.format(os.linesep, dict_to_table(ret))
 
     def installed_pandoc_extensions(self):
         '''
@@ -223,6 +247,7 @@ class Panuscript(object):
                         args=['--list-extensions'])
         return sorted([x[1:].strip() for x in ret.split(os.linesep) if x.strip().startswith('+')])
 
+    @traced('probe.formats')
     def supported_formats(self):
         '''
         Retrieves supported input[0] and output[1] Pandoc formats, image formats[2] and bibliographic formats[3].
@@ -246,43 +271,32 @@ class Panuscript(object):
             ext = "." + f.strip().split(' ', 1)[0].replace('*', '')
             mio.append(ext.lower())
 
-        pdio = {}
-        pdfmts = [pdin, pdout]
-        for x in range(len(pdfmts)):
-            pdf = {}
-            for fmt in pdfmts[x]:
-                if fmt in ['commonmark','gfm','markdown','markdown_github','markdown_mmd','markdown_phpextra','markdown_strict']:
-                    pdf[fmt] = ['.md','.markdown']
-                elif fmt in ['creole','dokuwiki','man','mediawiki','muse','t2t','tikiwiki','twiki','vimwiki','asciidoc','asciidoctor','jira','ms','plain','tei','xwiki','zimwiki']:
-                    pdf[fmt] = ['.txt']
-                elif fmt in ['docbook','docbook4','docbook5']: pdf[fmt] = ['.dbk','.xml']
-                elif fmt in ['docx']: pdf[fmt] = ['.docx']
-                elif fmt in ['epub','epub2','epub3']: pdf[fmt] = ['.epub']
-                elif fmt in ['f2b', 'jats','icml','opendocument']: pdf[fmt] = ['.xml']
-                elif fmt in ['haddock','native']: pdf[fmt] = ['.hs','.lhs']
-                elif fmt in ['html','dzslides','html4','html5','revealjs','s5','slideous','slidy']: pdf[fmt] = ['.html']
-                elif fmt in ['ipynb']: pdf[fmt] = ['.ipynb']
-                elif fmt in ['json']: pdf[fmt] = ['.json']
-                elif fmt in ['latex','beamer','context']: pdf[fmt] = ['.tex']
-                elif fmt in ['odt']: pdf[fmt] = ['.odt']
-                elif fmt in ['opml']: pdf[fmt] = ['.opml']
-                elif fmt in ['org']: pdf[fmt] = ['.org']
-                elif fmt in ['rst']: pdf[fmt] = ['.rst']
-                elif fmt in ['textile']: pdf[fmt] = ['.textile']
-                elif fmt in ['pdf']: pdf[fmt] = ['.pdf']
-                elif fmt in ['pptx']: pdf[fmt] = ['.pptx']
-                elif fmt in ['rtf']: pdf[fmt] = ['.rtf']
-                elif fmt in ['texinfo']: pdf[fmt] = ['.texinfo']
-                else: pdf[fmt] = ['.txt']
-            if x == 0: pdio['input'] = pdf
-            else: pdio['output'] = pdf
+        pdio = {'input': format_registry(tuple(pdin))[0],
+                'output': format_registry(tuple(pdout))[0]}
 
         return (pdio, bibio, mio)
 
+    def infer_reader(self, path):
+        '''
+        Returns the preferred supported Pandoc input format for the path's extension, or None.
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        if PREFERRED_READERS.get(ext) in self.pandoc_formats['input']: return PREFERRED_READERS[ext]
+        readers = self.pandoc_readers.get(ext)
+        if readers: return readers[0]
+
+    def infer_writer(self, path):
+        '''
+        Returns the preferred supported Pandoc output format for the path's extension, or None.
+        '''
+        writers = self.pandoc_writers.get(os.path.splitext(path)[1].lower())
+        if writers: return writers[0]
+
     def normalize_path(self, path_str):
         if os.path.dirname(path_str): return path_str
         else: return os.path.join(self.work_dir, path_str)
 
+    @traced('fetch_csl')
     def fetch_csl(self, style, update=False):
         '''
         Attempts to download the specified 'style' of CSL from the CSL repository
@@ -317,49 +331,100 @@ class Panuscript(object):
             else:
                 if self.verbose: print('Could not fetch CSL for \'{}\'. Please refer to the CSL homepage: https://citationstyles.org/.'.format(style))
 
+    @traced('extract_media')
     def extract_media(self, file):
         '''
         Extracts images or other media from the file to the file's directory.
+        Extracted files are named '<document name>_<media name>'. Media is extracted to a private
+        temporary directory next to the file and each file is then atomically moved into place,
+        so several documents in the same directory can be extracted at once.
+        Docx, odt and epub files are zip archives and their media is copied straight out of
+        the archive; other formats are parsed by Pandoc.
         '''
         file = self.normalize_path(file)
         dir = os.path.dirname(file)
-        cmd = ['.' + os.path.sep + self.p_exe_name]
-        if self.verbose: a = ['--verbose']
-        else: a = ['--quiet']
-        a += ['--extract-media={}'.format(dir), file]
-
-        if self.verbose: print(' '.join([x for x in cmd+a]).strip())
-
-        files = [x for x in run_shell(os.path.join(self.p_exe_path, self.p_exe_name),
-                        args=a).split(os.linesep) if x.startswith('[INFO]')]
-        if len(files) >= 1: files = [''.join(x.split('Extracting ',1)[1].split('..')[:-1]) for x in files]
-        # move files from the pandoc output to the specified directory
-        ret = []
-        if len(files) >= 1:
-            for f in files:
-                path, fn = os.path.split(f)
-                newname = os.path.join(path, os.path.split(file)[1] + "_" + fn)
-                os.rename(f, newname)
-                newf = os.path.join(os.path.dirname(path), os.path.split(newname)[1])
-                shutil.move(newname, newf)
-                ret.append(newf)
-            shutil.rmtree(path)
-
-            if self.grayscale or self.sizing_factor != 100:
-                [self.convert_image(f,f) for f in ret]
+        # same filesystem as the destination, so os.replace() is an atomic rename
+        tmp = tempfile.mkdtemp(prefix='.{}_media_'.format(os.path.basename(file)), dir=dir or None)
+        try:
+            files = None
+            if os.path.splitext(file)[1].lower() in ZIP_MEDIA:
+                try: files = unzip_media(file, tmp)
+                except (zipfile.BadZipFile, NotImplementedError) as err:
+                    if self.verbose: print('Reading {} with Pandoc: {}'.format(file, err))
+            if files is None:
+                cmd = ['.' + os.path.sep + self.p_exe_name]
+                if self.verbose: a = ['--verbose']
+                else: a = ['--quiet']
+                a += ['--extract-media={}'.format(tmp), file]
+
+                if self.verbose: print(' '.join([x for x in cmd+a]).strip())
+
+                ret = run_shell(os.path.join(self.p_exe_path, self.p_exe_name), args=a,
+                                stage='pandoc extract-media')
+                if self.verbose: print(ret)
+                # the directory is private to this extraction, so everything in it was extracted
+                # (Pandoc only logs the extracted files with --verbose)
+                files = sorted(os.path.join(d, f) for d, _, names in os.walk(tmp) for f in names)
+            # move files from the pandoc output to the document's directory
+            ret = []
+            with span('extract_media.move', files=len(files)):
+                for f in files:
+                    newf = os.path.join(dir, os.path.basename(file) + "_" + os.path.basename(f))
+                    os.replace(f, newf)
+                    ret.append(newf)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        if ret and (self.grayscale or self.sizing_factor != 100):
+            [self.convert_image(f,f) for f in ret]
 
         return ret
 
-    def convert_doc(self, input, read, write, *args):
+    def extract_media_many(self, files, workers=None, manifest=None, store=None, resume=False):
+        '''
+        Extracts media from several documents in parallel, 'workers' at a time (defaults to the CPU count).
+        Returns a dictionary mapping each document to the list of its extracted files, or to None
+        if the extraction failed. If 'manifest' is a path, the mapping is also written there as JSON.
+        If 'store' is a JobStore, every extraction is recorded, and with 'resume' documents whose
+        recorded extraction completed (and is unchanged) are not extracted again.
+        '''
+        files = list(dict.fromkeys(self.normalize_path(f) for f in files))
+        def extract(f):
+            if store is None: return extract_one(f)
+            settings = self.settings()
+            key, inputs = store.key('extract-media', [f], settings, [f])
+            if resume and store.completed(key): return store.last(key)['output']
+            start = time.perf_counter()
+            ret = extract_one(f)
+            store.record(key, 'extract-media', [f], inputs, settings, ret,
+                        'failed' if ret is None else 'done', time.perf_counter() - start)
+            return ret
+        def extract_one(f):
+            try: return self.extract_media(f)
+            except (OSError, ValueError) as err:
+                if self.verbose: print('Could not extract media from \'{}\': {}'.format(f, err))
+        from concurrent.futures import ThreadPoolExecutor
+        with span('extract_media_many', files=len(files)):
+            with ThreadPoolExecutor(max_workers=int(workers or os.cpu_count() or 1)) as pool:
+                ret = dict(zip(files, pool.map(extract, files)))
+        if manifest:
+            with open(self.normalize_path(manifest), 'w') as f:
+                json.dump(ret, f, indent=2)
+        return ret
+
+    @traced('convert_doc')
+    def convert_doc(self, input, read=None, write=None, *args, output=None):
         '''
         Converts input file, interpreted from read, and creates a new file of the same name
         in the format specific by write. Returns the new file's path.
+        If read is not given it is inferred from the input's extension. If output is given the
+        result is written there instead, and write, if not given, is inferred from its extension.
         The user can provide additional flag options through a args list with no guarantees. Arguments must be compatible with Pandoc.
         '''
         file = self.normalize_path(input)
-        ext = os.path.splitext(file)[1]
-        read = read.lower()
-        write = write.lower()
+        if output: output = self.normalize_path(output)
+        read = (read or self.infer_reader(file) or '').lower()
+        write = (write or (self.infer_writer(output) if output else None) or '').lower()
         pdinf = self.pandoc_formats['input']
         pdouf = self.pandoc_formats['output']
         if read in pdinf.keys() and write in pdouf.keys():
@@ -380,13 +445,17 @@ class Panuscript(object):
                     a += ['--bibliography', self.bibliography]
                 if os.path.isfile(self.csl):
                     a += ['--csl', self.csl]
-            if type(args) is list: a += args
-            out_file = os.path.splitext(file)[0] + pdouf[write][0]
+            a += [x for l in args if type(l) is list for x in l]
+            out_file = output or os.path.splitext(file)[0] + pdouf[write][0]
             a += [file, '-o', out_file]
 
             if self.verbose: print(' '.join([x for x in cmd+a]).strip())
 
-            ret = run_shell(os.path.join(self.p_exe_path, self.p_exe_name), args=a)
+            if write == 'pdf': stage = 'pandoc+{}'.format(self.pdf_engine)
+            elif self.citations: stage = 'pandoc+citeproc'
+            else: stage = 'pandoc'
+            ret = run_shell(os.path.join(self.p_exe_path, self.p_exe_name), args=a,
+                            stage='{} {}->{}'.format(stage, read, write))
             print(ret)
             if self.verbose: print(ret + os.linesep)
 
@@ -394,10 +463,113 @@ class Panuscript(object):
             else: return 'Unknown error'
         else: print('Cannot convert unsupported formats.')
 
+    @traced('convert_doc_split')
+    def convert_doc_split(self, input, read=None, write=None, *args, workers=None, output=None):
+        '''
+        Converts a large markdown document like convert_doc(), parsing parts of it in parallel.
+        The input is split at level one headings into about two chunks per worker (defaults to
+        the CPU count). Each chunk gets the document's YAML metadata block and link/footnote
+        definitions and is parsed to Pandoc's JSON AST in parallel. The ASTs are stitched into
+        one document, with header identifiers made unique as in a single parse, and written by one
+        final Pandoc run with the configured settings, so citations, the reference list and
+        cross references cover the whole document. That run loads the whole AST and is not
+        parallel, so split mode does not lower peak memory and only helps when parsing dominates.
+        With the markdown reader, every chunk also gets a reference definition for every heading,
+        so implicit header references ([Heading text]) resolve across chunks.
+        Other readers, documents without several level one headings and documents using example
+        lists ((@label), numbered across the whole document) use convert_doc().
+        Formats and output are inferred as in convert_doc().
+        '''
+        file = self.normalize_path(input)
+        if output: output = self.normalize_path(output)
+        read = (read or self.infer_reader(file) or '').lower()
+        write = (write or (self.infer_writer(output) if output else None) or '').lower()
+        if read not in MARKDOWN_READERS or 'json' not in self.pandoc_formats['input']:
+            return self.convert_doc(input, read, write, *args, output=output)
+        # fail before parsing any chunk
+        if write not in self.pandoc_formats['output']:
+            print('Cannot convert unsupported formats.')
+            return None
+        workers = int(workers or os.cpu_count() or 1)
+        with open(file, 'r') as f:
+            text = f.read()
+        if EXAMPLE.search(text):
+            if self.verbose: print('{} uses example lists, converting it as a whole.'.format(file))
+            return self.convert_doc(input, read, write, *args, output=output)
+        with span('convert_doc_split.split'):
+            meta, definitions, chunks = split_markdown(text, workers * 2, read == 'markdown')
+        if len(chunks) < 2: return self.convert_doc(input, read, write, *args, output=output)
+
+        dir, name = os.path.split(file)
+        tmp = tempfile.mkdtemp(prefix='.{}_split_'.format(name), dir=dir or None)
+        try:
+            paths = []
+            for i, chunk in enumerate(chunks):
+                path = os.path.join(tmp, 'chunk{}.md'.format(i))
+                with open(path, 'w') as f:
+                    f.write(meta + chunk + os.linesep*2 + definitions)
+                paths.append(path)
+
+            def parse(path):
+                a = ['--quiet', '--read={}'.format(read), '--write=json', path, '-o', path + '.json']
+                run_shell(os.path.join(self.p_exe_path, self.p_exe_name), args=a,
+                            stage='pandoc chunk {}->json'.format(read))
+                try:
+                    with open(path + '.json', 'r') as f:
+                        return json.load(f)
+                except (OSError, ValueError): return None
+
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                docs = list(pool.map(parse, paths))
+            if None in docs: return 'Unknown error'
+            with span('convert_doc_split.stitch', chunks=len(docs)):
+                doc = stitch_ast(docs)
+            stitched = os.path.join(tmp, os.path.splitext(name)[0] + '.split.json')
+            with open(stitched, 'w') as f:
+                json.dump(doc, f)
+
+            # images and other resources are relative to the original document
+            out = self.convert_doc(stitched, 'json', write, *args, ['--resource-path={}'.format(dir or '.')])
+            if out is None or not os.path.isfile(out): return out
+            out_file = output or os.path.splitext(file)[0] + os.path.splitext(out)[1]
+            # the output may be on another filesystem than the temporary directory
+            shutil.move(out, out_file)
+            return out_file
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def image_info(self, input):
+        '''
+        Returns the format, dimensions, bit depth, colorspace, density and decoded size of an image
+        read from its header (see imageinfo.py), or None if the format is not recognized.
+        Several paths can be given as a list, returning a dictionary of path: info.
+        '''
+        if isinstance(input, list): return dict((f, self.image_info(f)) for f in input)
+        return image_info(self.normalize_path(input))
+
+    def conversion_noop(self, input, output):
+        '''
+        Returns True if converting input to output with the current settings would not change the
+        image: the input already is in the output's format, the density matches ppi (or is left
+        alone at 72), the resizing factor is 100 and grayscale is off or the image is gray already.
+        '''
+        info = image_info(input)
+        if info is None or info['format'] != IMAGE_FORMATS.get(os.path.splitext(output)[1].lower()):
+            return False
+        if self.sizing_factor != 100: return False
+        if self.grayscale and info['colorspace'] != 'Gray': return False
+        if self.ppi != 72:
+            if info['density'] is None or any(abs(d - self.ppi) >= 0.5 for d in info['density']): return False
+        return True
+
+    @traced('convert_image')
     def convert_image(self, input, output, *args):
         '''
         Converts an image from the input format to the output format.
         Returns the path of the output file.
+        If the conversion would not change the image (see conversion_noop()), ImageMagick is not run
+        and the input is copied to the output, or left as is when they are the same file.
         The user can provide additional flag options through a args list with no guarantees. Arguments must be compatible with ImageMagick.
         '''
         input = self.normalize_path(input)
@@ -405,6 +577,12 @@ class Panuscript(object):
         output = self.normalize_path(output)
         oext = os.path.splitext(output)[1].lower()
         m_fmts = self.magick_formats
+        extra = [x for l in args if type(l) is list for x in l]
+        if iext in m_fmts and oext in m_fmts and not extra and self.conversion_noop(input, output):
+            if self.verbose: print('{} already matches the requested output, skipping ImageMagick.'.format(input))
+            with span('convert_image.noop', copied=input != output):
+                if os.path.abspath(input) != os.path.abspath(output): shutil.copyfile(input, output)
+            return output
         if iext in m_fmts and oext in m_fmts:
             cmd = ['.' + os.path.sep + self.m_exe_name]
             a = ['convert', input]
@@ -414,12 +592,13 @@ class Panuscript(object):
             if self.sizing_factor != 100:
                 a += ['-resize', '{}%'.format(self.sizing_factor)]
             if self.grayscale: a += ['-colorspace', 'Gray']
-            if type(args) is list: a += args
+            a += extra
             a += [output]
 
             if self.verbose: print(' '.join([x for x in cmd+a]).strip())
 
-            ret = run_shell(os.path.join(self.m_exe_path, self.m_exe_name), args=a)
+            ret = run_shell(os.path.join(self.m_exe_path, self.m_exe_name), args=a,
+                            stage='magick convert')
 
             if self.verbose: print(ret + os.linesep)
 
@@ -427,6 +606,119 @@ class Panuscript(object):
             else: return 'Unknown error'
         else: print('Cannot convert unsupported formats.')
 
+    @traced('image_derivatives')
+    def image_derivatives(self, input, sizes=None, out_dir=None, *args):
+        '''
+        Writes resized copies of an image in several formats from a single decode, for responsive
+        HTML/EPUB output. 'sizes' is a string 'label:width:format[+format],...' or a list of
+        (label, width, format) tuples, defaulting to DEFAULT_DERIVATIVES. Images are never upscaled.
+        Files are named '<image name>-<label>.<format>' and written to out_dir (defaults to the
+        input's directory). Returns the list of written files.
+        The ppi and grayscale settings apply, the resizing factor does not.
+        Additional ImageMagick arguments can be given as a list and are applied before resizing.
+        '''
+        input = self.normalize_path(input)
+        out_dir = self.normalize_path(out_dir) if out_dir else os.path.dirname(input)
+        derivatives = parse_derivatives(sizes)
+        m_fmts = self.magick_formats
+        if os.path.splitext(input)[1].lower() in m_fmts and all(
+                        '.' + fmt in m_fmts for _, _, fmt in derivatives):
+            cmd = ['.' + os.path.sep + self.m_exe_name]
+            a = ['convert', input]
+            if self.verbose: a += ['-verbose']
+            else: a += ['-quiet']
+            if self.ppi != 72: a += ['-density', '{}'.format(self.ppi)]
+            if self.grayscale: a += ['-colorspace', 'Gray']
+            a += [x for l in args if type(l) is list for x in l]
+            os.makedirs(out_dir, exist_ok=True)
+            # the decoded image stays in memory, each size resizes a clone once and writes it
+            # out in every format requested for that size
+            sizes = {}
+            for label, width, fmt in derivatives: sizes.setdefault((label, width), []).append(fmt)
+            out = []
+            for (label, width), fmts in sizes.items():
+                a += ['(', '+clone', '-resize', '{}x>'.format(width)]
+                for fmt in fmts:
+                    path = derivative_path(input, label, fmt, out_dir)
+                    a += ['-write', path]
+                    out.append(path)
+                a += ['+delete', ')']
+            a += ['null:']
+
+            if self.verbose: print(' '.join([x for x in cmd+a]).strip())
+
+            ret = run_shell(os.path.join(self.m_exe_path, self.m_exe_name), args=a,
+                            stage='magick derivatives')
+
+            if self.verbose: print(ret + os.linesep)
+
+            return [f for f in out if os.path.isfile(f)]
+        else: print('Cannot convert unsupported formats.')
+
+    @traced('srcset_html')
+    def srcset_html(self, html_file, sizes=None, out_dir=None):
+        '''
+        Rewrites the local <img> references of an HTML file to use the derivatives written by
+        image_derivatives() with the same 'sizes' and 'out_dir' (by default, derivatives are looked
+        for next to each image). Derivatives in formats other than the fallback (png if requested,
+        else the last format) become <source> elements of a <picture>, provided they cover every
+        width of the fallback.
+        Only existing derivatives are referenced and images without any are left unchanged.
+        Widths are the derivatives' actual widths, as images are never upscaled; derivatives
+        of the same width are listed once.
+        Returns the path of the rewritten file.
+        '''
+        html_file = self.normalize_path(html_file)
+        if out_dir: out_dir = self.normalize_path(out_dir)
+        derivatives = parse_derivatives(sizes)
+        fmts = list(dict.fromkeys(fmt for _, _, fmt in derivatives))
+        fallback = 'png' if 'png' in fmts else fmts[-1]
+        base = os.path.dirname(html_file)
+
+        def rewrite(m):
+            tag = m.group(0)
+            attr = re.search(r'\ssrc="([^"]+)"', tag)
+            if not attr or 'srcset=' in tag or re.match(r'[a-z]+:', attr.group(1)): return tag
+            src = attr.group(1)
+            image = os.path.join(base, src)
+            source_info = image_info(image)
+            sets = {}
+            for label, width, fmt in derivatives:
+                path = derivative_path(image, label, fmt, out_dir)
+                if not os.path.isfile(path): continue
+                info = image_info(path) or source_info
+                if info: width = min(width, info['width'])
+                url = os.path.relpath(path, base).replace(os.sep, '/')
+                widths = sets.setdefault(fmt, {})
+                # of several derivatives with the same width, keep the '1x' one for the plain src
+                if width not in widths or label == '1x': widths[width] = (width, url, label)
+            sets = dict((f, sorted(w.values())) for f, w in sets.items())
+            if fallback not in sets: return tag
+            sources = sets[fallback]
+            # the '1x' derivative, else the widest, stays the plain src for browsers without srcset
+            one_x = [u for w, u, l in sources if l == '1x']
+            new_src = one_x[0] if one_x else sources[-1][1]
+            srcset = ', '.join('{} {}w'.format(u, w) for w, u, l in sources)
+            img = tag[:attr.start()] + ' src="{}" srcset="{}"'.format(new_src, srcset) + tag[attr.end():]
+            # a format missing some of the fallback's widths would serve browsers the wrong size
+            widths = set(w for w, u, l in sources)
+            others = [f for f in fmts if f != fallback and f in sets and
+                        widths <= set(w for w, u, l in sets[f])]
+            if not others: return img
+            out = '<picture>'
+            for f in others:
+                out += '<source type="image/{}" srcset="{}" />'.format(IMAGE_MIME.get(f, f), ', '.join(
+                            '{} {}w'.format(u, w) for w, u, l in sets[f]))
+            return out + img + '</picture>'
+
+        with open(html_file, 'r') as f:
+            text = f.read()
+        with span('srcset_html.rewrite'):
+            text = re.sub(r'<img\b[^>]*>', rewrite, text)
+        with open(html_file, 'w') as f:
+            f.write(text)
+        return html_file
+
     def embed_yaml_bib(self, bibliography=None, *doc_file):
         '''
         Converts a supported bibliographic file to YAML metadata and appends it to the document file.
@@ -444,7 +736,8 @@ class Panuscript(object):
 
             if self.verbose: print(' '.join([x for x in cmd+a]).strip())
 
-            yaml_block = run_shell(os.path.join(self.pc_exe_path, self.pc_exe_name), args=a)
+            yaml_block = run_shell(os.path.join(self.pc_exe_path, self.pc_exe_name), args=a,
+                                    stage='citeproc bib2yaml')
             bib_yaml = "".join([x for x in re.split('\-{3}\n|\.{3}\n', yaml_block) if x != ''])
 
             if doc_file and os.path.isfile(doc_file):
@@ -482,7 +775,8 @@ class Panuscript(object):
             a = ['--bib2yaml', bib_file]
             if self.verbose: print(' '.join([x for x in cmd+a]).strip())
             return run_shell(os.path.join(
-                                self.pc_exe_path, self.pc_exe_name), args=a)
+                                self.pc_exe_path, self.pc_exe_name), args=a,
+                                stage='citeproc bib2yaml')
 
     def json_bib(self, bibliography=None):
         if bibliography != None: bib_file = self.normalize_path(bibliography)
@@ -490,8 +784,10 @@ class Panuscript(object):
         if os.path.splitext(bib_file)[1] in self.bib_formats:
             a = ['--bib2json', bib_file]
             return run_shell(os.path.join(
-                                self.pc_exe_path, self.pc_exe_name), args=a)
+                                self.pc_exe_path, self.pc_exe_name), args=a,
+                                stage='citeproc bib2json')
 
+    @traced('xref_md')
     def xref_md(self, md_file, bibliography=None):
         if bibliography != None: bib_file = self.normalize_path(bibliography)
         else: bib_file = self.bibliography
@@ -505,40 +801,185 @@ class Panuscript(object):
         return out_str
 
 
+    @traced('xref_md.scan')
     def md_references(self, md_file):
         with open(self.normalize_path(md_file), 'r') as md:
             # , ; : ] delimiters
             return [re.split('\,|\:|\;|\]',m.split(' ',1)[0])[0] for m in md.read().split('@')[1:]]
 
-def run_shell(executable, args, match=None):
+def run_shell(executable, args, match=None, stage=None):
     '''
     Returns the string printed to the Std.out from the executable.
     Args must be a list of arguments
+    Each call is traced as a 'run_shell' span labelled by stage (defaults to the executable name)
+    with the argv, exit code and bytes of output.
     '''
     try:
         assert(isinstance(args, list))
-        path, exe = os.path.split(executable)
-        os.chdir(path)
-        a = [".{}{}".format(os.path.sep, exe)]
+        exe = os.path.basename(executable)
+        # absolute executable path, the working directory is left alone so jobs can share the process
+        a = [os.path.abspath(executable)]
         a += args
 
-        proc = Popen(a, shell=False, stdout=PIPE,
-                     stderr=STDOUT, bufsize=1, universal_newlines=True)
+        with span('run_shell', stage=stage or exe, argv=a) as s:
+            proc = Popen(a, shell=False, stdout=PIPE,
+                         stderr=STDOUT, bufsize=1, universal_newlines=True)
 
-        ret = []
-        while True:
-            line = proc.stdout.readline()
-            if line != '' and proc.poll() is None:
+            ret = []
+            size = 0
+            # read to EOF; polling the process would drop lines still buffered after it exits
+            for line in proc.stdout:
+                size += len(line.encode('utf-8', 'replace'))
                 if match == None: ret.append(line)
                 elif re.search(match, line): ret.append(line)
-            else: break
-        proc.communicate()
+            proc.communicate()
+            s.update(exit_code=proc.returncode, bytes_out=size)
 
         return "".join(ret)
 
     except (OSError, ValueError, CalledProcessError) as err:
         return err
 
+# Pandoc formats and their file extensions. The first supported format listed for an extension
+# is the one inferred from it; formats not listed use '.txt'
+FORMAT_EXTENSIONS = [
+    (['markdown', 'commonmark', 'commonmark_x', 'gfm', 'markdown_github', 'markdown_mmd',
+        'markdown_phpextra', 'markdown_strict'], ['.md', '.markdown']),
+    (['html', 'html5', 'html4', 'dzslides', 'revealjs', 's5', 'slideous', 'slidy'], ['.html', '.htm']),
+    (['docx'], ['.docx']),
+    (['odt'], ['.odt']),
+    (['epub', 'epub3', 'epub2'], ['.epub']),
+    (['latex', 'beamer', 'context'], ['.tex']),
+    (['docbook', 'docbook4', 'docbook5'], ['.dbk', '.xml']),
+    (['jats', 'icml', 'opendocument'], ['.xml']),
+    (['fb2'], ['.fb2']),
+    (['native', 'haddock'], ['.hs', '.lhs']),
+    (['ipynb'], ['.ipynb']),
+    (['json'], ['.json']),
+    (['opml'], ['.opml']),
+    (['org'], ['.org']),
+    (['rst'], ['.rst']),
+    (['textile'], ['.textile']),
+    (['pdf'], ['.pdf']),
+    (['pptx'], ['.pptx']),
+    (['rtf'], ['.rtf']),
+    (['texinfo'], ['.texinfo']),
+    (['plain', 'asciidoc', 'asciidoctor', 'creole', 'dokuwiki', 'man', 'mediawiki', 'muse', 't2t',
+        'tikiwiki', 'twiki', 'vimwiki', 'jira', 'ms', 'tei', 'xwiki', 'zimwiki'], ['.txt'])]
+FORMAT_TABLE = dict((f, exts) for fmts, exts in FORMAT_EXTENSIONS for f in fmts)
+# Pandoc reads unknown text as markdown
+PREFERRED_READERS = {'.txt': 'markdown'}
+# probed executable information, keyed by executable paths and modification times
+CAPABILITIES = {}
+
+@functools.lru_cache(maxsize=None)
+def format_registry(formats):
+    '''
+    Returns (format -> extensions, extension -> formats) dictionaries for a tuple of supported
+    Pandoc format names. Formats are ordered by preference for each extension.
+    '''
+    exts = dict((f, FORMAT_TABLE.get(f, ['.txt'])) for f in formats)
+    by_ext = {}
+    for fmts, table_exts in FORMAT_EXTENSIONS:
+        for e in table_exts:
+            by_ext.setdefault(e, []).extend(f for f in fmts if f in exts)
+    for f in formats:
+        if f not in FORMAT_TABLE: by_ext.setdefault('.txt', []).append(f)
+    return exts, by_ext
+
+# zip based document formats: folder holding the media, None to take images from anywhere
+ZIP_MEDIA = {'.docx': 'word/media/', '.odt': 'Pictures/', '.epub': None}
+IMAGE_EXTS = ['.png', '.jpg', '.jpeg', '.gif', '.svg', '.bmp', '.tif', '.tiff', '.webp', '.emf', '.wmf']
+
+@traced('extract_media.unzip')
+def unzip_media(archive, dest_dir):
+    '''
+    Copies the media members of a docx, odt or epub archive to dest_dir and returns their paths.
+    Members are streamed without loading them into memory, and stored (uncompressed) members
+    are copied by the kernel straight from the archive where the platform allows it.
+    Raises zipfile.BadZipFile if the file is not a zip archive and NotImplementedError
+    for encrypted members.
+    '''
+    folder = ZIP_MEDIA[os.path.splitext(archive)[1].lower()]
+    ret = []
+    with open(archive, 'rb') as raw, zipfile.ZipFile(raw) as z:
+        members = []
+        for info in z.infolist():
+            name = info.filename
+            if info.is_dir(): continue
+            if folder is not None and not name.startswith(folder): continue
+            if folder is None and (name.startswith('META-INF/') or
+                                    os.path.splitext(name)[1].lower() not in IMAGE_EXTS): continue
+            if info.flag_bits & 0x1: raise NotImplementedError('encrypted member {}'.format(name))
+            members.append(info)
+        # members are named by their file name; parent folders are only kept in the name when
+        # several members share a file name, so they cannot collide
+        names = [os.path.basename(info.filename) for info in members]
+        counts = {}
+        for base in names: counts[base] = counts.get(base, 0) + 1
+        for info, base in zip(members, names):
+            fn = info.filename[len(folder):] if folder else info.filename
+            dest = os.path.join(dest_dir, base if counts[base] == 1 else fn.replace('/', '_'))
+            with open(dest, 'wb') as out:
+                if not (info.compress_type == zipfile.ZIP_STORED and copy_stored(raw, info, out)):
+                    with z.open(info) as src:
+                        shutil.copyfileobj(src, out, 1 << 20)
+            ret.append(dest)
+    return ret
+
+def copy_stored(raw, info, out):
+    '''
+    Copies an uncompressed zip member with os.sendfile. Returns False if unsupported.
+    '''
+    if not hasattr(os, 'sendfile'): return False
+    # local file header: 30 fixed bytes, then the file name and extra field
+    header = os.pread(raw.fileno(), 30, info.header_offset)
+    if header[:4] != b'PK\x03\x04': return False
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    offset = info.header_offset + 30 + name_len + extra_len
+    remaining = info.file_size
+    try:
+        while remaining > 0:
+            sent = os.sendfile(out.fileno(), raw.fileno(), offset, remaining)
+            if sent == 0: break
+            offset += sent
+            remaining -= sent
+    except OSError: pass
+    if remaining > 0: # discard the partial copy, the caller falls back to zipfile
+        out.seek(0)
+        out.truncate()
+        return False
+    return True
+
+# (label, width in pixels, format) of the responsive image derivatives written by default
+DEFAULT_DERIVATIVES = [('thumb', 160, 'webp'), ('thumb', 160, 'png'),
+                        ('1x', 800, 'webp'), ('1x', 800, 'png'),
+                        ('2x', 1600, 'webp'), ('2x', 1600, 'png')]
+
+# derivative formats whose MIME subtype differs from the extension
+IMAGE_MIME = {'jpg': 'jpeg', 'jpe': 'jpeg', 'tif': 'tiff', 'svg': 'svg+xml'}
+
+def parse_derivatives(sizes):
+    '''
+    Returns a list of (label, width, format) tuples from a 'label:width:format[+format],...'
+    string or list of tuples. None gives DEFAULT_DERIVATIVES.
+    '''
+    if sizes is None: return list(DEFAULT_DERIVATIVES)
+    if not isinstance(sizes, str):
+        return [(str(l), int(w), str(f).lower().lstrip('.')) for l, w, f in sizes]
+    ret = []
+    for item in sizes.split(','):
+        label, width, fmts = item.strip().split(':')
+        ret += [(label, int(width), f.lower().lstrip('.')) for f in fmts.split('+')]
+    return ret
+
+def derivative_path(input, label, fmt, out_dir=None):
+    '''
+    Returns the path of an image derivative: '<out_dir>/<image name>-<label>.<format>'.
+    '''
+    d, name = os.path.split(input)
+    return os.path.join(out_dir or d, '{}-{}.{}'.format(os.path.splitext(name)[0], label, fmt))
+
 def dict_to_table(dictionary, space=3):
     assert(isinstance(dictionary, dict) == True)
     d = {}
@@ -563,7 +1004,9 @@ def abspath_parts(self, abspath):
 
 def scrape_text(url):
     try:
-        req = requests.get(url)
+        import requests # only needed to download styles, slow to import
+        with span('fetch_csl.download', url=url):
+            req = requests.get(url)
         if req.text.strip() != '404: Not Found':
             return req.text
     except: return
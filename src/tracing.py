@@ -0,0 +1,137 @@
+'''
+Timing spans for Panuscript operations.
+Every run_shell call and each Python-side phase (capability probing, media moves,
+bibliography parsing, ...) is wrapped in a span. Finished spans are passed, as
+dictionaries, to registered hooks and optionally appended to a JSON-lines trace file.
+When no hook or trace file is registered, spans cost a single attribute check.
+'''
+import os, time, json, threading, functools
+from contextlib import contextmanager
+
+class Tracer:
+    def __init__(self):
+        self.hooks = []
+        self.trace_file = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.hooks) or self.trace_file is not None
+
+    def add_hook(self, hook):
+        '''
+        Registers a callable that receives each finished span as a dictionary with the keys
+        'name', 'start' (epoch seconds), 'duration' (seconds), 'parent', 'depth', 'thread',
+        'error' and any fields given to span(). Returns the hook.
+        Hooks are called in the thread that finished the span, so they must be thread safe.
+        '''
+        with self.lock: self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        with self.lock:
+            if hook in self.hooks: self.hooks.remove(hook)
+
+    def open_trace(self, path):
+        '''
+        Appends finished spans to the file at path, one JSON object per line.
+        '''
+        self.close_trace()
+        self.trace_file = open(path, 'a')
+        return path
+
+    def close_trace(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+    @contextmanager
+    def span(self, name, **fields):
+        '''
+        Times the enclosed block. Yields the span's field dictionary so the block
+        can attach results (e.g. exit codes) before the span is emitted.
+        '''
+        if not self.enabled:
+            yield fields
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        record = {'name': name, 'parent': stack[-1] if stack else None,
+                'depth': len(stack), 'thread': threading.current_thread().name}
+        stack.append(name)
+        start, wall = time.perf_counter(), time.time()
+        try:
+            yield fields
+        except BaseException as err:
+            record['error'] = repr(err)
+            raise
+        finally:
+            stack.pop()
+            record.update(start=wall, duration=time.perf_counter() - start)
+            record.setdefault('error', None)
+            record.update(fields)
+            self.emit(record)
+
+    def emit(self, record):
+        # hooks run outside the lock, so they may open spans or add and remove hooks
+        with self.lock: hooks = list(self.hooks)
+        for hook in hooks: hook(record)
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(record, default=str) + os.linesep)
+                self.trace_file.flush()
+
+# module level tracer shared by all Panuscript objects
+tracer = Tracer()
+
+def span(name, **fields):
+    return tracer.span(name, **fields)
+
+class StageSummary:
+    '''
+    A hook that aggregates spans per stage. run_shell spans are keyed by their 'stage'
+    field (the executable and operation), other spans by name.
+    Nested spans are included in their parent's time; the report lists the enclosing
+    span(s) of each stage.
+    '''
+    def __init__(self):
+        self.stages = {}
+        # hooks are called from the threads finishing spans
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        key = record['name']
+        if record.get('stage'): key += ':' + record['stage']
+        with self.lock:
+            s = self.stages.setdefault(key, {'calls': 0, 'total': 0.0, 'max': 0.0,
+                                            'errors': 0, 'parents': set()})
+            s['calls'] += 1
+            s['total'] += record['duration']
+            s['max'] = max(s['max'], record['duration'])
+            if record['parent']: s['parents'].add(record['parent'])
+            if record['error'] or record.get('exit_code') not in (None, 0): s['errors'] += 1
+
+    def report(self):
+        '''
+        Returns the per-stage summary as a plain text table (times in ms), slowest first.
+        '''
+        out = '~Stage summary~{}'.format(os.linesep)
+        out += '{:<40}{:>8}{:>12}{:>12}{:>8}  {}{}'.format('stage', 'calls', 'total', 'max', 'errors',
+                                                        'within', os.linesep)
+        for key, s in sorted(self.stages.items(), key=lambda x: -x[1]['total']):
+            out += '{:<40}{:>8}{:>12.2f}{:>12.2f}{:>8}  {}{}'.format(
+                    key, s['calls'], s['total'] * 1000, s['max'] * 1000, s['errors'],
+                    ', '.join(sorted(s['parents'])) or '-', os.linesep)
+        return out
+
+def traced(name):
+    '''
+    Decorator wrapping every call of the function in a span of the given name.
+    '''
+    def wrap(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return call
+    return wrap